@@ -0,0 +1,226 @@
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+
+log = logging.getLogger("varseq2hl7.archive")
+
+# Archive of every rendered HL7 message, written off the request path by a background thread.
+# Messages are appended to segment files sharded by date and sample:
+#   {directory}/{YYYY-MM-DD}/{shard}/{HHMMSS}_{pid}_{n}.hl7[.gz]
+# where the shard is taken from a hash of the sample ID, and each process rolls over to a new segment
+# once its current one reaches segment_size bytes (so processes never append to the same file). With
+# compression every message is its own gzip member, which keeps the segment a valid .gz file while
+# letting a single message be read back from its offset. index.sqlite3 records where each message
+# is, by sample ID, control ID and tracking ID. Date directories older than retention_days are
+# removed along with their index entries (0 keeps everything).
+SHARDS = 16
+INDEX_NAME = "index.sqlite3"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sample_id TEXT NOT NULL,
+    control_id TEXT,
+    tracking_id TEXT,
+    kind TEXT NOT NULL,
+    day TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archived_sample_id ON archived (sample_id);
+CREATE INDEX IF NOT EXISTS archived_control_id ON archived (control_id);
+CREATE INDEX IF NOT EXISTS archived_day ON archived (day);
+"""
+# how often the writer checks for date directories past retention
+PRUNE_INTERVAL = 3600
+
+def get_shard(sample_id):
+    return f"{int(hashlib.sha1(str(sample_id).encode('utf-8')).hexdigest(), 16) % SHARDS:02d}"
+
+class Archive():
+    def __init__(self, directory, compress=False, segment_size=64 * 1024 * 1024, retention_days=0):
+        self.directory = directory
+        self.compress = compress
+        self.segment_size = segment_size
+        self.retention_days = retention_days
+        # open segment of this process per (day, shard): [relative path, file, size]
+        self.segments = {}
+        self.sequence = 0
+        os.makedirs(directory, exist_ok=True)
+        with closing(self.connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        db = sqlite3.connect(os.path.join(self.directory, INDEX_NAME), timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def segment(self, day, shard, now):
+        segment = self.segments.get((day, shard))
+        if segment is None or segment[2] >= self.segment_size:
+            if segment is not None:
+                segment[1].close()
+            self.sequence += 1
+            name = time.strftime("%H%M%S", time.localtime(now)) + f"_{os.getpid()}_{self.sequence}.hl7" + (".gz" if self.compress else "")
+            path = os.path.join(day, shard, name)
+            os.makedirs(os.path.join(self.directory, day, shard), exist_ok=True)
+            f = open(os.path.join(self.directory, path), "ab")
+            segment = self.segments[(day, shard)] = [path, f, f.tell()]
+        return segment
+
+    # appends the messages of many submissions, entries of (sample_id, tracking_id, [(kind, control_id, message)]),
+    # and indexes them in one transaction
+    def write(self, entries):
+        now = time.time()
+        day = time.strftime("%Y-%m-%d", time.localtime(now))
+        rows = []
+        for sample_id, tracking_id, messages in entries:
+            segment = self.segment(day, get_shard(sample_id), now)
+            for kind, control_id, message in messages:
+                data = message.encode("utf-8")
+                if self.compress:
+                    data = gzip.compress(data, compresslevel=6)
+                segment[1].write(data)
+                rows.append((sample_id, control_id, tracking_id, kind, day, segment[0], segment[2], len(data), now))
+                segment[2] += len(data)
+        for _, f, _ in self.segments.values():
+            f.flush()
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                "INSERT INTO archived (sample_id, control_id, tracking_id, kind, day, segment, offset, length, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            db.execute("COMMIT")
+        # segments of earlier days won't be written to again
+        for key in [key for key in self.segments if key[0] != day]:
+            self.segments.pop(key)[1].close()
+        return len(rows)
+
+    def find(self, sample_id=None, control_id=None, tracking_id=None, limit=100):
+        conditions = []
+        params = []
+        for column, value in (("sample_id", sample_id), ("control_id", control_id), ("tracking_id", tracking_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        with closing(self.connect()) as db:
+            rows = db.execute(f"SELECT * FROM archived{where} ORDER BY id DESC LIMIT ?", params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def read(self, entry):
+        with open(os.path.join(self.directory, entry["segment"]), "rb") as f:
+            f.seek(entry["offset"])
+            data = f.read(entry["length"])
+        if entry["segment"].endswith(".gz"):
+            data = gzip.decompress(data)
+        return data.decode("utf-8")
+
+    # removes date directories older than retention_days, and their index entries
+    def prune(self, now=None):
+        if self.retention_days <= 0:
+            return []
+        now = time.time() if now is None else now
+        cutoff = time.strftime("%Y-%m-%d", time.localtime(now - self.retention_days * 86400))
+        removed = []
+        for day in sorted(os.listdir(self.directory)):
+            if len(day) == 10 and day < cutoff and os.path.isdir(os.path.join(self.directory, day)):
+                with closing(self.connect()) as db:
+                    db.execute("DELETE FROM archived WHERE day = ?", (day,))
+                for key in [key for key in self.segments if key[0] == day]:
+                    self.segments.pop(key)[1].close()
+                shutil.rmtree(os.path.join(self.directory, day), ignore_errors=True)
+                removed.append(day)
+        if removed:
+            log.info("Pruned archive", extra={"days": len(removed), "oldest": removed[0], "newest": removed[-1]})
+        return removed
+
+    def close(self):
+        for _, f, _ in self.segments.values():
+            f.close()
+        self.segments.clear()
+
+
+# Background thread that takes submissions off a queue and writes them to the archive in batches,
+# so the request thread only pays for a queue put. A batch that can't be written is logged and
+# dropped rather than ending the thread, since request threads block on a full queue
+class ArchiveWriter(threading.Thread):
+    def __init__(self, archive, max_queue=10000, batch_size=100):
+        super().__init__(name="archive-writer", daemon=True)
+        self.archive = archive
+        self.queue = queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.stopping = False
+        self.last_prune = 0
+
+    def submit(self, sample_id, tracking_id, messages):
+        # blocks only when the writer has fallen max_queue submissions behind
+        self.queue.put((sample_id, tracking_id, messages))
+
+    def stop(self, timeout=10):
+        self.stopping = True
+        self.queue.put(None)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            entries = []
+            try:
+                entry = self.queue.get(timeout=1)
+                while entry is not None:
+                    entries.append(entry)
+                    if len(entries) >= self.batch_size:
+                        break
+                    entry = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            if entries:
+                try:
+                    self.archive.write(entries)
+                except Exception:
+                    log.exception("Couldn't archive messages", extra={"submissions": len(entries)})
+            if self.stopping and self.queue.empty():
+                break
+            if time.time() - self.last_prune >= PRUNE_INTERVAL:
+                self.last_prune = time.time()
+                try:
+                    self.archive.prune()
+                except Exception:
+                    log.exception("Couldn't prune archive")
+        self.archive.close()
+
+
+# Prints archived messages of a sample, control ID or tracking ID:
+#   python3 archive.py archive/ --sample-id 24-123456
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search the HL7 message archive')
+    parser.add_argument('directory', help='Archive directory (--archive-dir of the server)')
+    parser.add_argument('--sample-id', help='Sample ID to look up')
+    parser.add_argument('--control-id', help='Message control ID (MSH-10) to look up')
+    parser.add_argument('--tracking-id', help='Tracking ID of a submission to look up')
+    parser.add_argument('--limit', type=int, default=10, help='Maximum number of messages to print (newest first)')
+    parser.add_argument('--list', action='store_true', help='Only list the matching messages, without their content')
+    args = parser.parse_args()
+    if not (args.sample_id or args.control_id or args.tracking_id):
+        parser.error("one of --sample-id, --control-id or --tracking-id is required")
+    archive = Archive(args.directory)
+    entries = archive.find(args.sample_id, args.control_id, args.tracking_id, args.limit)
+    for entry in entries:
+        created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["created"]))
+        print(f"# {created} {entry['sample_id']} {entry['kind']} {entry['control_id']} {entry['segment']}@{entry['offset']}")
+        if not args.list:
+            print(archive.read(entry).replace("\r", "\n"))
+    if not entries:
+        sys.exit("No archived messages found")
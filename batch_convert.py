@@ -0,0 +1,121 @@
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from varseq_info import VarSeqInfo
+from control_ids import get_control_id
+
+# Renders HL7 messages for many VSClinical JSONs at once, without going through the Flask server.
+# Used to regenerate historical reports after mapping changes:
+#   python3 batch_convert.py reports/ --output-dir hl7_out
+#   python3 batch_convert.py 'reports/2024-*.json' --list more_jsons.txt --send --interface-host HOST --interface-port PORT
+parser = argparse.ArgumentParser(description='Convert VSClinical JSONs to HL7 messages in parallel')
+parser.add_argument('inputs', nargs='*', help='VSClinical JSON files, directories containing them, or glob patterns')
+parser.add_argument('--list', dest='list_file', help='File containing one VSClinical JSON path per line (like curl_jsons_to_flask.py --jsons_file)')
+parser.add_argument('--output-dir', default='hl7_out', help='Directory to write {name}_tumor_msg.txt / {name}_normal_msg.txt to, where name is the input file name without .json')
+parser.add_argument('--workers', default=os.cpu_count(), type=int, help='Number of worker processes')
+parser.add_argument('--send', action='store_true', help='Also send the rendered messages to the interface server')
+parser.add_argument('--interface-host', type=str, help='Hostname of the interface server (required with --send)')
+parser.add_argument('--interface-port', type=int, help='Port of the interface server (required with --send)')
+
+def expand_inputs(inputs, list_file=None):
+    paths = []
+    if list_file:
+        with open(list_file, "r") as f:
+            inputs = list(inputs) + [line.strip() for line in f if line.strip()]
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+        elif os.path.exists(path):
+            paths.append(path)
+        else:
+            matches = sorted(glob.glob(path))
+            paths.extend(matches if matches else [path]) # a missing file is reported as a failure
+    # keep the first occurrence of each file so overlapping inputs aren't converted twice
+    return list(dict.fromkeys(paths))
+
+# Outputs are named after the input file rather than the sample, since several versions of a report
+# (e.g. historical and amended) share a sample ID
+def output_name(path):
+    name = os.path.basename(path)
+    return name[:-len(".json")] if name.lower().endswith(".json") else name
+
+# runs in a worker process; only the messages (not the parsed JSON) go back to the parent
+def convert_file(path, output_dir, keep_messages):
+    with open(path, "r") as f:
+        vs_info = VarSeqInfo(json.load(f))
+    tumor_msg, normal_msg = vs_info.get_tumor_msg(), vs_info.get_normal_msg()
+    name = output_name(path)
+    with open(os.path.join(output_dir, f"{name}_tumor_msg.txt"), "w") as f:
+        f.write(tumor_msg)
+    if normal_msg:
+        with open(os.path.join(output_dir, f"{name}_normal_msg.txt"), "w") as f:
+            f.write(normal_msg)
+    if keep_messages:
+        return vs_info.sample_id, tumor_msg, normal_msg
+    return vs_info.sample_id, None, None
+
+def format_error(e):
+    return f"{type(e).__name__}: {e}"
+
+def main():
+    args = parser.parse_args()
+    if args.send and (not args.interface_host or args.interface_port is None):
+        parser.error("--send requires --interface-host and --interface-port")
+    paths = expand_inputs(args.inputs, args.list_file)
+    if not paths:
+        parser.error("no input JSONs given")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    pool = None
+    if args.send:
+        from mllp import MLLPConnectionPool
+        pool = MLLPConnectionPool(args.interface_host, args.interface_port, size=1)
+
+    results = {}
+    # inputs with the same file name in different directories would overwrite each other's outputs
+    names = {}
+    for path in paths:
+        name = output_name(path)
+        if name in names:
+            results[path] = (None, f"output {name}_*_msg.txt would overwrite the output of {names[name]}")
+            print(f"FAILED {path}: {results[path][1]}", file=sys.stderr)
+        else:
+            names[name] = path
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(convert_file, path, args.output_dir, args.send): path for path in paths if path not in results}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                sample_id, tumor_msg, normal_msg = future.result()
+            except Exception as e:
+                results[path] = (None, format_error(e))
+                print(f"FAILED {path}: {format_error(e)}", file=sys.stderr)
+                continue
+            # messages are sent from this process, in completion order, over a single pooled connection
+            if pool:
+                try:
+                    messages = [(get_control_id(msg), msg) for msg in (tumor_msg, normal_msg) if msg]
+                    with pool.connection() as client:
+                        errors = [r for r in client.send_messages(messages, window=len(messages)) if isinstance(r, Exception)]
+                    if errors:
+                        raise errors[0]
+                except Exception as e:
+                    results[path] = (sample_id, "send failed: " + format_error(e))
+                    print(f"FAILED {path} ({sample_id}): send failed: {format_error(e)}", file=sys.stderr)
+                    continue
+            results[path] = (sample_id, None)
+            print(f"OK {path} ({sample_id})")
+    if pool:
+        pool.close()
+
+    failures = [(path, error) for path, (_, error) in results.items() if error]
+    print(f"\n{len(paths) - len(failures)}/{len(paths)} JSONs converted" + (" and sent" if args.send else "") + f", {len(failures)} failed")
+    for path, error in failures:
+        print(f"  {path}: {error}")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
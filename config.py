@@ -0,0 +1,103 @@
+import argparse
+import os
+from destinations import load_destinations
+
+# Settings for the HL7 server. Every setting can come from a command line flag or from a
+# VARSEQ2HL7_* environment variable (e.g. --interface-host / VARSEQ2HL7_INTERFACE_HOST), with flags
+# taking precedence, so the app can be started by a WSGI server where there is no command line:
+#   VARSEQ2HL7_INTERFACE_HOST=HOST VARSEQ2HL7_INTERFACE_PORT=PORT gunicorn -c gunicorn.conf.py 'varseq_hl7:create_app()'
+ENV_PREFIX = "VARSEQ2HL7_"
+
+def parse_bool(value):
+    return str(value).lower() in ("1", "true", "yes")
+
+# (name, type, default, help); a default of None means the setting is required
+# (the interface host and port aren't when --destinations lists the interface servers instead)
+SETTINGS = [
+    ("interface_host", str, None, 'Hostname of the interface server to send HL7 messages to'),
+    ("interface_port", int, None, 'Port of the interface server to send HL7 messages to'),
+    ("destinations", str, "", 'JSON file listing several interface servers to deliver every message to, each with its own pool, timeout and retry settings (see destinations.py); replaces --interface-host/--interface-port'),
+    ("flask_port", int, 5000, 'Port to launch the local Flask server on'),
+    ("bind", str, "127.0.0.1", 'Address to listen on'),
+    ("pool_size", int, 2, 'Open connections to the interface server, each with its own delivery thread (per worker process)'),
+    ("interface_timeout", float, 30, 'Seconds to wait on the interface server (connect, ACK, or a free pooled connection)'),
+    ("send_window", int, 8, 'Messages sent to the interface server ahead of their ACKs on one connection (1 waits for every ACK)'),
+    ("idle_timeout", float, 300, 'Seconds a pooled connection may sit idle before it is replaced instead of reused'),
+    ("outbox", str, "outbox.sqlite3", 'SQLite file holding messages waiting to be delivered to the interface server'),
+    ("outbox_retention_days", int, 30, 'Days sent, failed and superseded messages keep their full text in the outbox; after that only their content hash and status are kept for duplicate detection (0 keeps everything)'),
+    ("max_attempts", int, 50, 'Delivery attempts per message before it is marked failed'),
+    ("retry_backoff", float, 5, 'Seconds before the first retry of a failed delivery; doubles on every attempt up to 10 minutes'),
+    ("archive_dir", str, "archive", 'Directory to archive every rendered message in, sharded by date and sample with an index by sample and control ID (empty to not archive)'),
+    ("archive_compress", parse_bool, False, 'Gzip archived messages'),
+    ("archive_segment_mb", float, 64, 'Size in MB at which an archive segment file is closed and a new one started'),
+    ("archive_retention_days", int, 0, 'Days archived messages are kept (0 keeps them forever)'),
+    ("log_level", str, "INFO", 'Lowest level of log messages to write (DEBUG, INFO, WARNING, ERROR)'),
+    ("log_format", str, "text", 'Log line format: "text" (key=value fields) or "json" (one object per line)'),
+    ("dedup", parse_bool, True, 'Answer a report whose mapped content was already submitted (and not failed) to every destination with that submission instead of sending it again, and only send it to destinations that lack it; POST with ?force=1 to resend anyway'),
+    ("dedup_cache_size", int, 256, 'Responses to recent submissions kept in memory for answering duplicates'),
+    ("render_cache_size", int, 5000, 'Rendered variants kept in memory, so re-submitted reports only render the variants that changed (0 to turn off)'),
+    ("profile_dir", str, "", 'Directory to write request profiles to; profiling is off unless this is set (see profiling.py)'),
+    ("profile_sample_rate", float, 0.0, 'Fraction of reports profiled without being asked to (with --profile-dir)'),
+    ("profile_keep", int, 50, 'Number of newest profiles kept in --profile-dir'),
+    ("profile_collapsed", parse_bool, False, 'Also write folded stacks (.collapsed) for flame graphs next to each profile'),
+    ("serve", str, "dev", 'How to serve the app: "dev" (Flask development server with the reloader) or "prod" (pre-forked gunicorn workers, or a threaded server if gunicorn is not installed)'),
+    ("workers", int, 4, 'Worker processes in prod mode'),
+    ("threads", int, 8, 'Request threads per worker process in prod mode'),
+]
+SERVE_MODES = ("dev", "prod")
+LOG_FORMATS = ("text", "json")
+CHOICES = {"serve": SERVE_MODES, "log_format": LOG_FORMATS}
+
+class Config():
+    def __init__(self, **settings):
+        for name, type_, default, _ in SETTINGS:
+            value = settings.pop(name, default)
+            setattr(self, name, type_(value) if value is not None else None)
+        if settings:
+            raise TypeError(f"Unknown settings: {', '.join(settings)}")
+
+    def validate(self):
+        missing = [name for name, _, default, _ in SETTINGS if default is None and getattr(self, name) is None]
+        if self.destinations:
+            missing = [name for name in missing if name not in ("interface_host", "interface_port")]
+        if missing:
+            raise ValueError("Missing required settings: " + ", ".join(
+                f"--{name.replace('_', '-')} (or {ENV_PREFIX}{name.upper()})" for name in missing
+            ))
+        for name, choices in CHOICES.items():
+            if getattr(self, name) not in choices:
+                raise ValueError(f"Unknown {name.replace('_', ' ')} {getattr(self, name)!r}, expected one of {', '.join(choices)}")
+        load_destinations(self)
+        return self
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        settings = {}
+        for name, _, _, _ in SETTINGS:
+            if ENV_PREFIX + name.upper() in environ:
+                settings[name] = environ[ENV_PREFIX + name.upper()]
+        return cls(**settings)
+
+    @classmethod
+    def from_args(cls, argv=None, environ=None):
+        config = cls.from_env(environ)
+        args = build_parser().parse_args(argv)
+        for name, _, _, _ in SETTINGS:
+            if getattr(args, name) is not None:
+                setattr(config, name, getattr(args, name))
+        return config
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name, _, _, _ in SETTINGS}
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='HL7 Server')
+    for name, type_, default, help in SETTINGS:
+        flag = '--' + name.replace('_', '-')
+        # defaults are left to Config so an unset flag doesn't override the environment
+        kwargs = {"choices": CHOICES[name]} if name in CHOICES else {}
+        if type_ is parse_bool:
+            kwargs = {"nargs": "?", "const": True}
+        parser.add_argument(flag, type=type_, default=None, help=help + ('' if default is None else f' (default {default})'), **kwargs)
+    return parser
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+# Message control IDs (MSH-10) for outgoing messages. The interface engine echoes MSH-10 back in MSA-2,
+# which is how ACKs are matched to messages, and may reject a control ID it has seen before, so every
+# message needs its own.
+# IDs are 20 characters (the ST length limit for MSH-10 in v2.3): the UTC time they were made to the
+# second (YYMMDDHHMMSS; local time would repeat an hour when DST ends), the full process ID in 5 base 36
+# digits, so live server worker processes never share a prefix, and a 3 base 36 digit sequence number.
+# Within a process they are unique and strictly increasing, even across clock adjustments, and they stay
+# unique across restarts as long as the clock doesn't go back.
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def base36(number, width):
+    digits = ""
+    for _ in range(width):
+        number, digit = divmod(number, 36)
+        digits = DIGITS[digit] + digits
+    return digits
+
+class ControlIDGenerator():
+    PID_DIGITS = 5 # 36 ** 5 is above the largest Linux PID (2 ** 22)
+    SEQUENCE_DIGITS = 3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.prefix = ""
+        self.second = 0
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # a forked worker process gets its own prefix and starts over
+                self.pid = os.getpid()
+                self.prefix = base36(self.pid, self.PID_DIGITS)
+                self.second = 0
+            now = int(time.time())
+            if now > self.second:
+                self.second = now
+                self.sequence = 0
+            else:
+                self.sequence += 1
+                if self.sequence >= 36 ** self.SEQUENCE_DIGITS:
+                    # more IDs in one second than the sequence holds; borrow the next second
+                    self.second += 1
+                    self.sequence = 0
+            stamp = time.strftime("%y%m%d%H%M%S", time.gmtime(self.second))
+            return f"{stamp}{self.prefix}{base36(self.sequence, self.SEQUENCE_DIGITS)}"
+
+CONTROL_IDS = ControlIDGenerator()
+
+# MSH-10 of a rendered message
+def get_control_id(msg):
+    fields = msg.split("\r", 1)[0].split(msg[3:4] or "|")
+    return fields[9] if len(fields) > 9 else ""
@@ -0,0 +1,64 @@
+import json
+import re
+
+# Interface servers every message is delivered to. Without --destinations there is one, "default",
+# made from --interface-host/--interface-port and the server's pool and retry settings. With
+# --destinations FILE, the file lists them as JSON, e.g. to deliver to production Beaker, the Beaker
+# test environment and a research warehouse listener:
+#   [
+#     {"name": "prod", "host": "beaker.example.org", "port": 6661},
+#     {"name": "tst", "host": "beaker-tst.example.org", "port": 6661, "max_attempts": 5},
+#     {"name": "warehouse", "host": "10.0.0.5", "port": 2575, "interface_timeout": 5, "send_window": 32}
+#   ]
+# A destination can override any of DESTINATION_SETTINGS; the rest come from the server's own settings.
+# Messages are rendered once and queued once per destination, and each destination has its own
+# connection pool and delivery worker, so a slow or unreachable one doesn't hold up the others.
+DEFAULT_NAME = "default"
+DESTINATION_SETTINGS = ("pool_size", "interface_timeout", "idle_timeout", "send_window", "max_attempts", "retry_backoff")
+# names end up in the outbox, metrics labels and log lines
+NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+class Destination():
+    def __init__(self, name, host, port, **settings):
+        self.name = name
+        self.host = host
+        self.port = port
+        for setting in DESTINATION_SETTINGS:
+            setattr(self, setting, settings[setting])
+
+    def __repr__(self):
+        return f"Destination({self.name!r}, {self.host!r}, {self.port!r})"
+
+def load_destinations(config):
+    defaults = {setting: getattr(config, setting) for setting in DESTINATION_SETTINGS}
+    if not config.destinations:
+        return [Destination(DEFAULT_NAME, config.interface_host, config.interface_port, **defaults)]
+    try:
+        with open(config.destinations, "r") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Couldn't read destinations from {config.destinations}: {e}") from e
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"Expected a list of destinations in {config.destinations}")
+    destinations = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not all(key in entry for key in ("name", "host", "port")):
+            raise ValueError(f"Every destination needs a name, host and port, got {entry!r}")
+        name = str(entry["name"])
+        if not NAME_RE.match(name):
+            raise ValueError(f"Invalid destination name {name!r} (letters, digits, '_', '.' and '-' only)")
+        if any(destination.name == name for destination in destinations):
+            raise ValueError(f"Duplicate destination {name!r}")
+        unknown = set(entry) - {"name", "host", "port"} - set(DESTINATION_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings for destination {name!r}: {', '.join(sorted(unknown))}")
+        settings = dict(defaults)
+        try:
+            for setting in DESTINATION_SETTINGS:
+                if setting in entry:
+                    settings[setting] = type(defaults[setting])(entry[setting])
+            port = int(entry["port"])
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid setting for destination {name!r}: {e}") from e
+        destinations.append(Destination(name, str(entry["host"]), port, **settings))
+    return destinations
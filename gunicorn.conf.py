@@ -0,0 +1,11 @@
+# gunicorn settings for serving varseq_hl7 without its own launcher:
+#   VARSEQ2HL7_INTERFACE_HOST=HOST VARSEQ2HL7_INTERFACE_PORT=PORT gunicorn -c gunicorn.conf.py 'varseq_hl7:create_app()'
+# (python3 varseq_hl7.py --serve prod ... runs the same setup from command line flags)
+import os
+from varseq_hl7 import post_worker_init, worker_exit
+
+bind = f"{os.environ.get('VARSEQ2HL7_BIND', '127.0.0.1')}:{os.environ.get('VARSEQ2HL7_FLASK_PORT', '5000')}"
+workers = int(os.environ.get("VARSEQ2HL7_WORKERS", 4))
+threads = int(os.environ.get("VARSEQ2HL7_THREADS", 8))
+# load the app and mappings once in the master; each worker then starts its own delivery worker and pool
+preload_app = True
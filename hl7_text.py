@@ -0,0 +1,142 @@
+import html
+import re
+from textwrap import TextWrapper
+
+# Turns the HTML interpretations VSClinical exports into HL7 TX values: tags stripped, entities decoded,
+# HL7 delimiters escaped, and lines wrapped at word boundaries with \.br\ breaks.
+# wrap_text reproduces textwrap.wrap(text, width) exactly (so messages built from plain <p>/<em> text are
+# unchanged), but only splits a word into textwrap's hyphenated chunks when the whole word doesn't fit.
+LINE_BREAK = "\\.br\\"
+
+# tags that end a line; every other tag (<p>, <em>, <strong>, <span>, <ul>, ...) is dropped without a trace
+BREAK_TAGS = {"br", "li", "tr"}
+# any real tag, entity, or character we rewrite, found in one pass over the text. A "<" that doesn't start
+# a tag (e.g. "VAF <5%") is left alone
+MARKUP_RE = re.compile(r"<(/?)([A-Za-z][A-Za-z0-9]*)(?:\s[^<>]*)?/?>|&(?:#[0-9]+|#[xX][0-9A-Fa-f]+|[A-Za-z][A-Za-z0-9]*);|[–\x00]")
+# marks a <br>/<li> line break until the text is wrapped
+BREAK = "\x00"
+
+# textwrap turns every one of these into a space before wrapping
+WHITESPACE_TRANS = str.maketrans("\t\n\x0b\x0c\r", "     ")
+RUNS_RE = re.compile(r" +|[^ ]+")
+OTHER_WHITESPACE_RE = re.compile(r"[^\S ]")
+WORDSEP_RE = TextWrapper.wordsep_re
+
+HL7_ESCAPES = str.maketrans({"\\": "\\E\\", "|": "\\F\\", "^": "\\S\\", "~": "\\R\\", "&": "\\T\\"})
+
+def _replace_markup(match):
+    text = match.group(0)
+    if text[0] == "<":
+        tag = match.group(2).lower()
+        if tag in BREAK_TAGS and not match.group(1):
+            return BREAK + "- " if tag == "li" else BREAK
+        return ""
+    if text[0] == "&":
+        if text == "&nbsp;":
+            return " "
+        decoded = html.unescape(text)
+        return decoded.replace("\xa0", " ").replace("–", "-")
+    # "–" (en dash) or a stray NUL, which would otherwise be taken for a line break
+    return "-" if text == "–" else ""
+
+def strip_html(text):
+    return MARKUP_RE.sub(_replace_markup, text)
+
+def escape_hl7(text):
+    return text.translate(HL7_ESCAPES)
+
+# Fills one line starting at text[pos] the way textwrap does, one run (word or run of spaces) at a time,
+# splitting the word that doesn't fit into textwrap's chunks (after hyphens, before em-dashes) and
+# breaking chunks longer than a whole line. carry holds the chunks the previous line left over, as a
+# stack covering the start of text[pos:endpos]. Returns the line, where the next one starts, and its carry
+def _wrap_line(text, pos, endpos, width, carry):
+    carry_end = pos + sum(map(len, carry))
+    runs = RUNS_RE.findall(text, carry_end, endpos) if endpos > carry_end else []
+    runs.reverse()
+    runs.extend(carry)
+    line = []
+    line_len = 0
+    while runs:
+        run = runs[-1]
+        if line_len + len(run) <= width:
+            line.append(runs.pop())
+            line_len += len(run)
+            continue
+        chunks = [chunk for chunk in WORDSEP_RE.split(run) if chunk]
+        if len(chunks) == 1:
+            break
+        runs.pop()
+        runs.extend(reversed(chunks))
+    if runs and len(runs[-1]) > width:
+        # a chunk longer than a whole line is broken at the last hyphen that fits, or else at the width
+        chunk = runs[-1]
+        space_left = width - line_len
+        end = space_left
+        hyphen = chunk.rfind("-", 0, space_left)
+        if hyphen > 0 and any(c != "-" for c in chunk[:hyphen]):
+            end = hyphen + 1
+        line.append(chunk[:end])
+        line_len += end
+        runs[-1] = chunk[end:]
+    if line and line[-1].strip() == "":
+        line.pop()
+    return "".join(line), pos + line_len, runs
+
+def wrap_text(text, width=110):
+    if "\t" in text:
+        text = text.expandtabs()
+    text = text.translate(WHITESPACE_TRANS)
+    n = len(text)
+    # textwrap treats these as droppable whitespace too; they (and space runs too long for a line) never
+    # show up in real interpretations, so those texts skip the line-at-a-time shortcut below
+    exact = bool(OTHER_WHITESPACE_RE.search(text)) or " " * (width + 1) in text
+    lines = []
+    pos = 0
+    carry = []
+    while pos < n:
+        if lines:
+            # the whitespace a line was broken at doesn't carry over to the next line
+            first = carry[-1] if carry else RUNS_RE.match(text, pos).group()
+            if first.strip() == "":
+                pos += len(first)
+                if carry:
+                    carry.pop()
+                if pos >= n:
+                    break
+        end = pos + width
+        if exact:
+            line, pos, carry = _wrap_line(text, pos, n, width, carry)
+        elif end >= n:
+            line, pos = text[pos:].rstrip(" "), n
+        elif carry:
+            word_end = text.find(" ", end)
+            line, pos, carry = _wrap_line(text, pos, n if word_end == -1 else word_end, width, carry)
+        elif text[end] == " " or text[end - 1] == " ":
+            # the line ends at (or in the spaces before) a word boundary. If it's exactly full and the next
+            # word is longer than a line, textwrap keeps the trailing spaces, so let _wrap_line do it
+            next_word_end = end if text[end] == " " else RUNS_RE.match(text, end).end()
+            if next_word_end - end > width:
+                line, pos, carry = _wrap_line(text, pos, next_word_end, width, carry)
+            else:
+                line = text[pos:end].rstrip(" ")
+                pos = pos + len(line) if text[end - 1] == " " and text[end] == " " else end
+        else:
+            # a word straddles the width; it moves to the next line unless textwrap would split it
+            word_start = text.rfind(" ", pos, end) + 1 or pos
+            word_end = text.find(" ", end)
+            word_end = n if word_end == -1 else word_end
+            if word_start == pos or word_end - word_start > width or "-" in text[word_start:word_end]:
+                line, pos, carry = _wrap_line(text, pos, word_end, width, carry)
+            else:
+                line, pos = text[pos:word_start].rstrip(" "), word_start
+        if line:
+            lines.append(line)
+    return lines
+
+def format_interp(interp, width=110):
+    lines = []
+    for i, paragraph in enumerate(strip_html(interp).split(BREAK)):
+        # text after a <br>/<li> starts its own line, so its leading spaces are dropped; the first paragraph's
+        # are kept through wrapping (they count towards the first line's width) and stripped at the end
+        lines.extend(escape_hl7(line) for line in wrap_text(paragraph if i == 0 else paragraph.strip(), width))
+    return LINE_BREAK.join(lines).strip()
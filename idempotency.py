@@ -0,0 +1,40 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# VarSeq re-posts a report every time it is re-opened or re-signed. A report whose mapped content is
+# unchanged would render to the same messages (apart from MSH-7, the send date, and MSH-10, the control
+# ID), so instead of rendering and sending it again the server answers with the earlier submission.
+# The outbox remembers the content hash of every submission (so duplicates are caught across restarts
+# and worker processes), and a small in-memory LRU holds the responses of recent ones.
+
+# hash of exactly what the messages are built from: the header and variant records of a VarSeqInfo
+# (see records.py), in message order and a canonical JSON form
+def content_hash(vs_info):
+    header = vs_info.header.as_dict()
+    variants = [variant.as_dict() for variant in vs_info.variants]
+    canonical = json.dumps({"header": header, "variants": variants}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class LRUCache():
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
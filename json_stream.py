@@ -0,0 +1,77 @@
+import re
+
+# Splits a stream of VSClinical JSONs into one document at a time without reading the whole stream:
+# newline-delimited JSON (one report per line), a JSON array of reports, or reports simply concatenated.
+# Only the report being parsed (plus one read) is held in memory, so a backfill of thousands of
+# reports can be POSTed in one request.
+CHUNK_SIZE = 65536
+# outside strings only these bytes change the nesting; inside a string only a quote or an escape matters
+STRUCTURE_RE = re.compile(rb'["{}\[\]]')
+STRING_RE = re.compile(rb'\\.|"', re.DOTALL)
+SEPARATORS = b" \t\r\n,"
+
+class JSONStreamError(ValueError):
+    pass
+
+# yields the bytes of each top-level JSON object in the stream (json.loads each one)
+def iter_json_objects(stream, chunk_size=CHUNK_SIZE):
+    buffer = bytearray()
+    pos = 0
+    in_array = False
+
+    def read_more():
+        chunk = stream.read(chunk_size)
+        if chunk:
+            buffer.extend(chunk)
+        return bool(chunk)
+
+    while True:
+        while True:
+            while pos < len(buffer) and buffer[pos] in SEPARATORS:
+                pos += 1
+            if pos < len(buffer) or not read_more():
+                break
+        if pos >= len(buffer):
+            if in_array:
+                raise JSONStreamError("Stream ended inside a JSON array")
+            return
+        first = buffer[pos:pos + 1]
+        if first == b"[" and not in_array:
+            in_array = True
+            pos += 1
+            continue
+        if first == b"]" and in_array:
+            in_array = False
+            pos += 1
+            continue
+        if first != b"{":
+            raise JSONStreamError(f"Expected a JSON object, found {bytes(first)!r}")
+
+        start = pos
+        depth = 0
+        in_string = False
+        while True:
+            match = (STRING_RE if in_string else STRUCTURE_RE).search(buffer, pos)
+            if match is None:
+                # nothing left to scan; a lone backslash at the end still needs the byte it escapes
+                pending_escape = in_string and pos < len(buffer) and buffer.endswith(b"\\")
+                pos = len(buffer) - pending_escape
+                if not read_more():
+                    raise JSONStreamError("Stream ended inside a JSON object")
+                continue
+            token = match.group()
+            pos = match.end()
+            if in_string:
+                in_string = token != b'"'
+            elif token == b'"':
+                in_string = True
+            elif token in (b"{", b"["):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    break
+        yield bytes(buffer[start:pos])
+        # drop the finished document so the buffer only ever holds the one being read
+        del buffer[:pos]
+        pos = 0
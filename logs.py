@@ -0,0 +1,53 @@
+import json
+import logging
+import sys
+import time
+
+# Structured, levelled logging for the server. Modules log through logging.getLogger("varseq2hl7...")
+# and attach fields with extra=, e.g.
+#   log.info("Queued messages", extra={"sample_id": sample_id, "tracking_id": tracking_id})
+# which setup_logging renders either as key=value text or as one JSON object per line (--log-format json).
+# attributes every LogRecord has; anything else on a record came from extra=
+STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+def get_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in STANDARD_ATTRS}
+
+def format_time(record):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+# strings with spaces (or empty ones) are quoted so key=value pairs stay parseable
+def format_field(value):
+    if isinstance(value, str) and (" " in value or not value):
+        return json.dumps(value)
+    return value
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{format_time(record)} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        fields = get_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={format_field(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": format_time(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(get_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging(level="INFO", format="text"):
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter() if format == "json" else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
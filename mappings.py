@@ -7,7 +7,12 @@ def _get_variant_id(idx):
     quotient, remainder = divmod(idx, len(alphabet))
     return _get_variant_id(quotient - 1) + alphabet[remainder]
 
+# IDs for the first 52 + 52 * 52 variants (2a ... 2ZZ) are computed once; larger reports fall back to _get_variant_id
+VARIANT_IDS = [f"2{_get_variant_id(idx)}" for idx in range(len(alphabet) + len(alphabet) ** 2)]
+
 def get_variant_id(idx):
+    if 0 <= idx < len(VARIANT_IDS):
+        return VARIANT_IDS[idx]
     return f"2{_get_variant_id(idx)}"
 
 LOINCS = {
@@ -46,6 +51,9 @@ LOINCS = {
     "7102426": ["Mean Depth", "ST"],
 }
 
+# the "TYPE|CODE^NAME^LOINC" part of every OBX segment, built once per code instead of once per segment
+LOINC_PREFIXES = {code: f"{loinc_type}|{code}^{loinc_name}^LOINC" for code, (loinc_name, loinc_type) in LOINCS.items()}
+
 # Maps Sequence Ontology Terms to EPIC molecular consequence and DNA change type
 SEQ_ONTOLOGY_MAP = {
     "transcript_ablation": "Transcript Ablation",
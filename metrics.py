@@ -0,0 +1,171 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process counters and histograms for the request and delivery paths, rendered in the Prometheus
+# text format at /metrics. Each server process keeps its own (with --serve prod, every gunicorn worker
+# answers /metrics with the numbers of the reports it handled).
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            children = sorted(self.children.items())
+        for key, child in children:
+            lines.extend(child.render(self.name, self.labelnames, key))
+        return lines
+
+
+class CounterValue():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self, name, labelnames, key):
+        return [f"{name}{format_labels(labelnames, key)} {format_value(self.value)}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return CounterValue()
+
+
+class HistogramValue():
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name, labelnames, key):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = 'le="' + format_value(bound) + '"'
+            lines.append(f"{name}_bucket{format_labels(labelnames, key, le)} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labelnames, key)} {format_value(total)}")
+        lines.append(f"{name}_count{format_labels(labelnames, key)} {count}")
+        return lines
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.labels(**labels).observe(time.perf_counter() - start)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# request path, labelled by coverageSummary.panelName
+STAGE_SECONDS = REGISTRY.histogram(
+    "varseq2hl7_stage_seconds", "Time spent in each stage of handling a report",
+    ("stage", "panel"))
+REPORTS = REGISTRY.counter(
+    "varseq2hl7_reports_total", "Reports received, by outcome",
+    ("panel", "outcome"))
+REPORT_VARIANTS = REGISTRY.histogram(
+    "varseq2hl7_report_variants", "Variants per report",
+    ("panel",), COUNT_BUCKETS)
+MESSAGE_BYTES = REGISTRY.histogram(
+    "varseq2hl7_message_bytes", "Size of rendered HL7 messages",
+    ("panel", "kind"), BYTE_BUCKETS)
+
+# delivery path
+MLLP_SECONDS = REGISTRY.histogram(
+    "varseq2hl7_mllp_seconds", "Time spent connecting to the interface, sending messages, and waiting for their ACKs",
+    ("stage", "destination"))
+DELIVERIES = REGISTRY.counter(
+    "varseq2hl7_deliveries_total", "Delivery attempts, by result (sent, nak, error)",
+    ("kind", "destination", "result"))
+
+# panel label of a raw VSClinical JSON (before it has been parsed into a VarSeqInfo)
+def get_panel(vs_json):
+    try:
+        return vs_json["coverageSummary"]["panelName"]
+    except (KeyError, TypeError):
+        return ""
@@ -0,0 +1,246 @@
+import logging
+import queue
+import re
+import select
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from metrics import MLLP_SECONDS
+
+log = logging.getLogger("varseq2hl7.mllp")
+
+# MLLP framing: <SB>message<EB><CR>
+SB = b"\x0b"
+EB = b"\x1c"
+CR = b"\r"
+RECV_BUFFER = 4096
+# MSA-1 codes for an accepted message (original and enhanced acknowledgment mode); anything else is a NAK
+ACCEPT_CODES = ("AA", "CA")
+
+# An ACK or NAK from the interface engine: MSA-1 is the acknowledgment code, MSA-2 the control ID
+# (MSH-10) of the message it answers, and MSA-3 the engine's explanation
+class Ack():
+    def __init__(self, raw):
+        self.raw = raw
+        self.code = self.control_id = self.text = ""
+        raw = raw.strip()
+        sep = raw[3:4] if raw.startswith("MSH") and len(raw) > 3 else "|"
+        for segment in re.split(r"\r\n|\r|\n", raw):
+            if segment.startswith("MSA"):
+                fields = segment.split(sep) + ["", "", ""]
+                self.code, self.control_id, self.text = fields[1], fields[2], fields[3]
+                break
+
+    @property
+    def accepted(self):
+        return self.code in ACCEPT_CODES
+
+    def __str__(self):
+        return self.raw
+
+class AckError(Exception):
+    def __init__(self, ack):
+        super().__init__(f"{ack.code or 'No MSA'} for message {ack.control_id}" + (f": {ack.text}" if ack.text else ""))
+        self.ack = ack
+
+# ACKs whose MSA-2 matched none of the messages in flight, and at least one of them a NAK, so there's
+# no telling which messages it rejected
+class UnmatchedAckError(AckError):
+    def __init__(self, ack, in_flight):
+        Exception.__init__(self, f"{ack.code} with unknown control ID {ack.control_id!r} while {in_flight} messages were unacknowledged")
+        self.ack = ack
+
+# Long-lived MLLP connections to the interface engine, shared between request threads.
+# The engine drops sockets that sit idle too long, so every checkout health-checks the socket
+# and a message that fails on a reused socket is retried once on a fresh connection.
+class PooledMLLPConnection():
+    def __init__(self, pool):
+        self.pool = pool
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        self.close()
+        # the timeout covers connecting too, so an unreachable host fails within it
+        with MLLP_SECONDS.time(stage="connect", destination=self.pool.name):
+            sock = socket.create_connection((self.pool.host, self.pool.port), self.pool.timeout)
+        if self.pool.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.socket = sock
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            self.socket = None
+
+    def is_healthy(self):
+        if self.socket is None:
+            return False
+        if time.monotonic() - self.last_used > self.pool.idle_timeout:
+            return False
+        # an idle MLLP socket should have nothing to read; if it's readable, the peer either
+        # closed it (recv returns b"") or sent something we didn't ask for, and neither is usable
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+            if not readable:
+                return True
+            self.socket.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            pass
+        return False
+
+    # Sends [(control_id, message)] with up to window messages awaiting ACKs, matched by MSA-2; returns one
+    # Ack, AckError, UnmatchedAckError or connection error per message, in order
+    def send_messages(self, messages, window=1):
+        results = [None] * len(messages)
+        try:
+            self._send_messages(messages, window, results)
+        except (OSError, ValueError) as e:
+            self.close()
+            if self.reused and isinstance(e, ConnectionError) and not any(results):
+                # the engine dropped a socket we thought was alive; reconnect and resend once
+                try:
+                    self.connect()
+                    self._send_messages(messages, window, results)
+                except (OSError, ValueError) as retry_error:
+                    self.close()
+                    e = retry_error
+                else:
+                    return results
+            for idx, result in enumerate(results):
+                if result is None:
+                    results[idx] = e
+        return results
+
+    def _send_messages(self, messages, window, results):
+        sock = self.socket
+        encoding = self.pool.encoding
+        in_flight = deque() # indexes of messages sent and waiting for an ACK
+        sent_at = {}
+        next_idx = 0
+        buffer = b""
+        unmatched = [] # ACKs for unknown control IDs, waiting for the rest of the messages in flight
+        send_seconds = MLLP_SECONDS.labels(stage="send", destination=self.pool.name)
+        ack_seconds = MLLP_SECONDS.labels(stage="ack_wait", destination=self.pool.name)
+        while next_idx < len(messages) or in_flight:
+            if self.pool.unmatched_acks:
+                window = 1
+            while next_idx < len(messages) and len(in_flight) < max(1, window) and not unmatched:
+                start = time.perf_counter()
+                sock.sendall(SB + messages[next_idx][1].encode(encoding) + EB + CR)
+                sent_at[next_idx] = time.perf_counter()
+                send_seconds.observe(sent_at[next_idx] - start)
+                in_flight.append(next_idx)
+                next_idx += 1
+            data = sock.recv(RECV_BUFFER)
+            if not data:
+                raise ConnectionResetError(f"{self.pool.host}:{self.pool.port} closed the connection with {len(in_flight)} message(s) unacknowledged")
+            buffer += data
+            end = buffer.find(EB + CR)
+            while end != -1:
+                frame, buffer = buffer[:end], buffer[end + 2:]
+                ack = Ack(frame[frame.find(SB) + 1:].decode(encoding, errors="replace"))
+                idx = match_ack(ack, messages, in_flight)
+                if not in_flight:
+                    log.warning("Ignoring ACK with no message in flight", extra={"control_id": ack.control_id, "host": self.pool.host, "port": self.pool.port})
+                    end = buffer.find(EB + CR)
+                    continue
+                if idx is None and len(in_flight) == 1 and not unmatched:
+                    idx = in_flight[0]
+                    self.unmatched_ack(ack, messages[idx][0])
+                if idx is None:
+                    unmatched.append(ack)
+                    self.unmatched_ack(ack, None)
+                else:
+                    ack_seconds.observe(time.perf_counter() - sent_at[idx])
+                    in_flight.remove(idx)
+                    results[idx] = ack if ack.accepted else AckError(ack)
+                if unmatched and len(unmatched) == len(in_flight):
+                    # every message in flight has an answer, we just can't tell which
+                    nak = next((answer for answer in unmatched if not answer.accepted), None)
+                    for idx, answer in zip(in_flight, unmatched):
+                        results[idx] = answer if nak is None else UnmatchedAckError(nak, len(in_flight))
+                    in_flight.clear()
+                    unmatched.clear()
+                end = buffer.find(EB + CR)
+        self.last_used = time.monotonic()
+        self.reused = True
+
+    def unmatched_ack(self, ack, control_id):
+        if not self.pool.unmatched_acks:
+            log.warning("The interface answered with an unknown control ID, sending one message at a time from now on", extra={
+                "control_id": ack.control_id, "message_control_id": control_id, "host": self.pool.host, "port": self.pool.port})
+        self.pool.unmatched_acks = True
+
+
+# the oldest in-flight message with the ACK's control ID; an ACK without MSA-2 answers the oldest message
+def match_ack(ack, messages, in_flight):
+    for idx in in_flight:
+        if messages[idx][0] == ack.control_id:
+            return idx
+    if not ack.control_id and in_flight:
+        return in_flight[0]
+    return None
+
+
+class MLLPConnectionPool():
+    # name labels the pool's metrics (the destination it connects to)
+    def __init__(self, host, port, size=2, timeout=30, idle_timeout=300, keepalive=True, name="", encoding="utf-8"):
+        self.name = name
+        self.encoding = encoding
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        # set once the interface answers with a control ID that matches no message (see send_messages)
+        self.unmatched_acks = False
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def checkout(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No MLLP connection to {self.host}:{self.port} available after {self.timeout}s")
+        try:
+            while not self.idle.empty():
+                conn = self.idle.get_nowait()
+                if conn.is_healthy():
+                    return conn
+                conn.close()
+            return PooledMLLPConnection(self)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn, broken=False):
+        if broken:
+            conn.close()
+        else:
+            self.idle.put(conn)
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        except BaseException:
+            # we don't know what state the stream is in (e.g. a half-read ACK), so don't reuse it
+            self.checkin(conn, broken=True)
+            raise
+        self.checkin(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
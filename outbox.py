@@ -0,0 +1,341 @@
+import logging
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from control_ids import get_control_id
+
+log = logging.getLogger("varseq2hl7.outbox")
+
+# Durable queue of rendered HL7 messages waiting to be delivered to the interface servers.
+# Each POST to /receivejson gets one tracking ID covering its tumor (and normal) message, with one row
+# per message and destination (see destinations.py), each delivered and retried on its own.
+# Rows move pending -> sending -> sent, or back to pending with a later next_attempt when a send fails,
+# until max_attempts is reached and they are marked failed.
+# A newer submission of a sample must never be overtaken by an older one (an amended result would be
+# overwritten in Epic), so queueing it marks the sample's older pending messages of the same kind
+# superseded, an older message that fails after a newer one was queued is superseded instead of retried,
+# and a message isn't claimed while an earlier message of the same sample and kind is still pending or
+# sending at the same destination (tumor and normal results don't overwrite each other).
+# Sent, failed and superseded rows keep their message text for retention_days; after that only what
+# duplicate detection and /status need is kept (0 keeps everything).
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tracking_id TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    destination TEXT NOT NULL DEFAULT 'default',
+    control_id TEXT,
+    content_hash TEXT,
+    segments INTEGER,
+    message TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    ack TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_tracking_id ON messages (tracking_id);
+CREATE INDEX IF NOT EXISTS messages_due ON messages (status, next_attempt);
+"""
+# columns added since the first outboxes were created, with the indexes that use them
+MIGRATIONS = [
+    ("control_id", "ALTER TABLE messages ADD COLUMN control_id TEXT"),
+    ("content_hash", "ALTER TABLE messages ADD COLUMN content_hash TEXT"),
+    ("destination", "ALTER TABLE messages ADD COLUMN destination TEXT NOT NULL DEFAULT 'default'"),
+    ("segments", "ALTER TABLE messages ADD COLUMN segments INTEGER"),
+]
+INDEXES = """
+CREATE INDEX IF NOT EXISTS messages_content_hash ON messages (content_hash);
+CREATE INDEX IF NOT EXISTS messages_destination_due ON messages (destination, status, next_attempt);
+DROP INDEX IF EXISTS messages_sample;
+CREATE INDEX IF NOT EXISTS messages_sample_kind ON messages (sample_id, destination, kind, status);
+"""
+# a row waiting behind an earlier message of the same sample and kind to the same destination
+HELD_BACK = """EXISTS (
+    SELECT 1 FROM messages earlier WHERE earlier.sample_id = messages.sample_id AND earlier.destination = messages.destination
+    AND earlier.kind = messages.kind AND earlier.id < messages.id AND earlier.tracking_id != messages.tracking_id AND earlier.status IN ('pending', 'sending')
+)"""
+# how often a delivery worker purges rows past retention
+PURGE_INTERVAL = 3600
+
+# every segment ends in \r (or \r\n) except the last OBX
+def count_segments(msg):
+    return msg.count("\r") + (not msg.endswith("\r"))
+
+class Outbox():
+    def __init__(self, path, lease=300, retention_days=0):
+        self.path = path
+        # a row stuck in "sending" longer than this belongs to a worker that died mid-send
+        self.lease = lease
+        self.retention_days = retention_days
+        with closing(self.connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            columns = [row["name"] for row in db.execute("PRAGMA table_info(messages)")]
+            for column, statement in MIGRATIONS:
+                if column not in columns:
+                    db.execute(statement)
+            db.executescript(INDEXES)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def enqueue(self, sample_id, messages, content_hash=None, destinations=("default",)):
+        tracking_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            # the sample's older messages that haven't gone out yet would only overwrite these
+            db.executemany(
+                "UPDATE messages SET status = 'superseded', updated = ? WHERE sample_id = ? AND destination = ? AND kind = ? AND status = 'pending'",
+                [(now, sample_id, destination, kind) for destination in destinations for kind, _ in messages],
+            )
+            db.executemany(
+                "INSERT INTO messages (tracking_id, sample_id, kind, destination, control_id, content_hash, segments, message, next_attempt, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (tracking_id, sample_id, kind, destination, get_control_id(message), content_hash, count_segments(message), message, now, now, now)
+                    for destination in destinations for kind, message in messages
+                ],
+            )
+            db.execute("COMMIT")
+        return tracking_id
+
+    # due messages, of one destination or (destination=None) all of them
+    def claim(self, limit=1, destination=None):
+        now = time.time()
+        where, params = self.destination_filter(destination)
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute(
+                f"SELECT * FROM messages WHERE {where}((status = 'pending' AND next_attempt <= ?) OR (status = 'sending' AND updated <= ?)) AND NOT {HELD_BACK} ORDER BY id LIMIT ?",
+                params + [now, now - self.lease, limit],
+            ).fetchall()
+            db.executemany(
+                "UPDATE messages SET status = 'sending', attempts = attempts + 1, updated = ? WHERE id = ?",
+                [(now, row["id"]) for row in rows],
+            )
+            db.execute("COMMIT")
+        return rows
+
+    def mark_sent(self, message_id, ack):
+        with closing(self.connect()) as db:
+            db.execute(
+                "UPDATE messages SET status = 'sent', ack = ?, last_error = NULL, updated = ? WHERE id = ?",
+                (ack, time.time(), message_id),
+            )
+
+    # retried at retry_at (or failed for good without one), unless a newer submission of the sample was queued since
+    def mark_error(self, message_id, error, retry_at=None):
+        status = "pending" if retry_at else "failed"
+        with closing(self.connect()) as db:
+            db.execute(
+                """UPDATE messages SET status = CASE WHEN EXISTS (
+                    SELECT 1 FROM messages newer WHERE newer.sample_id = messages.sample_id AND newer.destination = messages.destination
+                    AND newer.kind = messages.kind AND newer.id > messages.id AND newer.tracking_id != messages.tracking_id
+                ) THEN 'superseded' ELSE ? END, last_error = ?, next_attempt = ?, updated = ? WHERE id = ?""",
+                (status, error, retry_at or 0, time.time(), message_id),
+            )
+
+    def next_attempt(self, destination=None):
+        where, params = self.destination_filter(destination)
+        with closing(self.connect()) as db:
+            row = db.execute(f"SELECT MIN(next_attempt) FROM messages WHERE {where}status = 'pending' AND NOT {HELD_BACK}", params).fetchone()
+        return row[0]
+
+    # Drops the text (and ACK) of sent, failed and superseded rows last updated more than retention_days
+    # ago, keeping their content hash, control ID, segment count and status. Rows without a content hash
+    # (queued with dedup off) aren't needed for anything and are deleted.
+    def purge(self, destination=None, now=None):
+        if self.retention_days <= 0:
+            return 0
+        now = time.time() if now is None else now
+        where, params = self.destination_filter(destination)
+        params = params + [now - self.retention_days * 86400]
+        done = f"{where}status IN ('sent', 'failed', 'superseded') AND updated < ?"
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            deleted = db.execute(f"DELETE FROM messages WHERE {done} AND content_hash IS NULL", params).rowcount
+            emptied = db.execute(f"UPDATE messages SET message = '', ack = NULL WHERE {done} AND message != ''", params).rowcount
+            db.execute("COMMIT")
+        if deleted or emptied:
+            log.info("Purged outbox", extra={"destination": destination, "deleted": deleted, "emptied": emptied})
+        return deleted + emptied
+
+    def destination_filter(self, destination):
+        if destination is None:
+            return "", []
+        return "destination = ? AND ", [destination]
+
+    # For each of destinations, the latest submission of a report with this content hash that was
+    # delivered there or is still being delivered (none of its messages there failed for good or were
+    # superseded), unless a submission of the sample with other content was queued there since.
+    # Returns {destination: row of (tracking_id, sample_id, last_id)}; destinations without one are left out
+    def find_submissions(self, content_hash, destinations):
+        found = {}
+        with closing(self.connect()) as db:
+            rows = db.execute(
+                "SELECT destination, tracking_id, sample_id, MAX(id) AS last_id FROM messages WHERE content_hash = ? GROUP BY destination, tracking_id HAVING SUM(status NOT IN ('sent', 'pending', 'sending')) = 0 ORDER BY last_id DESC",
+                (content_hash,),
+            ).fetchall()
+            for row in rows:
+                if row["destination"] not in destinations or row["destination"] in found:
+                    continue
+                # the destination holds (or will hold) the newer content
+                if db.execute(
+                    "SELECT 1 FROM messages WHERE sample_id = ? AND destination = ? AND id > ? AND content_hash IS NOT ? AND status IN ('sent', 'pending', 'sending') LIMIT 1",
+                    (row["sample_id"], row["destination"], row["last_id"], content_hash),
+                ).fetchone() is None:
+                    found[row["destination"]] = row
+        return found
+
+    # Fails the undelivered messages of destinations that are no longer configured (e.g. ones queued for
+    # "default" before --destinations was used), which no worker would ever deliver. Their reports are then
+    # no longer duplicates, so re-posting them delivers them to the configured destinations.
+    def fail_unknown_destinations(self, destinations):
+        placeholders = ", ".join("?" * len(destinations))
+        with closing(self.connect()) as db:
+            return db.execute(
+                f"UPDATE messages SET status = 'failed', last_error = 'Destination ' || destination || ' is not configured', updated = ? WHERE status IN ('pending', 'sending') AND destination NOT IN ({placeholders})",
+                [time.time()] + list(destinations),
+            ).rowcount
+
+    # [(kind, control_id, segments)] of a submission's messages
+    def messages(self, tracking_id):
+        with closing(self.connect()) as db:
+            # every destination got the same messages; rows from before the control_id and segments
+            # columns were added still have their text
+            rows = db.execute(
+                "SELECT kind, control_id, segments, CASE WHEN control_id IS NULL OR segments IS NULL THEN message END AS message FROM messages WHERE tracking_id = ? GROUP BY kind ORDER BY MIN(id)",
+                (tracking_id,),
+            ).fetchall()
+        return [
+            (row["kind"], row["control_id"] or (get_control_id(row["message"]) if row["message"] else None),
+             row["segments"] if row["segments"] is not None else (count_segments(row["message"]) if row["message"] else None))
+            for row in rows
+        ]
+
+    def status(self, tracking_id):
+        with closing(self.connect()) as db:
+            rows = db.execute("SELECT * FROM messages WHERE tracking_id = ? ORDER BY id", (tracking_id,)).fetchall()
+        if not rows:
+            return None
+        destinations = {}
+        for row in rows:
+            destinations.setdefault(row["destination"], []).append(row["status"])
+        return {
+            "tracking_id": tracking_id,
+            "sample_id": rows[0]["sample_id"],
+            "destinations": {destination: summarize(statuses) for destination, statuses in destinations.items()},
+            "messages": [
+                {
+                    "kind": row["kind"],
+                    "destination": row["destination"],
+                    "control_id": row["control_id"],
+                    "status": row["status"],
+                    "attempts": row["attempts"],
+                    "last_error": row["last_error"],
+                    "ack": row["ack"],
+                    "created": row["created"],
+                    "updated": row["updated"],
+                }
+                for row in rows
+            ],
+        }
+
+# overall delivery state of a submission's messages to one destination
+def summarize(statuses):
+    for status in ("failed", "sending", "pending", "superseded"):
+        if status in statuses:
+            return status
+    return "sent"
+
+
+# Background thread that drains the outbox (the messages of one destination, or all of them), handing
+# up to batch_size due messages at a time to send_func(rows). send_func returns one result per row: the ACK (stored on the row), or an exception
+# (e.g. a NAK or a dropped connection), in which case just that message is retried with exponential backoff.
+# Several workers may drain the same destination; claim hands each row to only one of them.
+class DeliveryWorker(threading.Thread):
+    def __init__(self, outbox, send_func, max_attempts=50, backoff=5, max_backoff=600, poll_interval=5, batch_size=1, destination=None, name=None):
+        super().__init__(name=name or (f"outbox-delivery-{destination}" if destination else "outbox-delivery"), daemon=True)
+        self.outbox = outbox
+        self.destination = destination
+        self.send_func = send_func
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.last_purge = 0
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    def retry_at(self, attempts):
+        if attempts >= self.max_attempts:
+            return None
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return time.time() + delay * random.uniform(0.8, 1.2)
+
+    def deliver(self, rows):
+        try:
+            results = self.send_func(rows)
+        except OSError as e:
+            # the interface being down or unreachable is expected and retried, so no traceback
+            log.warning("Delivery failed", extra={"destination": self.destination, "messages": len(rows), "error": f"{type(e).__name__}: {e}"})
+            results = [e] * len(rows)
+        except Exception as e:
+            log.exception("Delivery failed", extra={"destination": self.destination, "messages": len(rows)})
+            results = [e] * len(rows)
+        for row, result in zip(rows, results):
+            if isinstance(result, Exception):
+                retry_at = self.retry_at(row["attempts"] + 1)
+                log.warning("Delivery failed, will retry" if retry_at else "Delivery failed, giving up", extra={
+                    "sample_id": row["sample_id"], "kind": row["kind"], "destination": row["destination"], "control_id": row["control_id"],
+                    "attempt": row["attempts"] + 1, "error": f"{type(result).__name__}: {result}",
+                })
+                self.outbox.mark_error(row["id"], f"{type(result).__name__}: {result}", retry_at)
+            else:
+                ack = result.decode(errors="replace") if isinstance(result, bytes) else str(result)
+                self.outbox.mark_sent(row["id"], ack)
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.clear()
+            try:
+                rows = self.outbox.claim(self.batch_size, self.destination)
+            except sqlite3.Error:
+                log.exception("Couldn't claim messages from the outbox")
+                rows = []
+            if rows:
+                self.deliver(rows)
+            else:
+                self.wakeup.wait(self.idle_wait())
+            if time.time() - self.last_purge >= PURGE_INTERVAL:
+                self.last_purge = time.time()
+                try:
+                    self.outbox.purge(self.destination)
+                except sqlite3.Error:
+                    log.exception("Couldn't purge the outbox")
+
+    def idle_wait(self):
+        try:
+            next_attempt = self.outbox.next_attempt(self.destination)
+        except sqlite3.Error:
+            next_attempt = None
+        if next_attempt is None:
+            return self.poll_interval
+        return max(0, min(self.poll_interval, next_attempt - time.time()))
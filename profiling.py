@@ -0,0 +1,134 @@
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+log = logging.getLogger("varseq2hl7.profiling")
+
+# Opt-in profiling of single reports. When the server is started with --profile-dir, a POST to
+# /receivejson with an "X-Profile: 1" header or ?profile=1 (or a random --profile-sample-rate of all
+# requests) is converted under cProfile, and the stats are written to the directory as
+# {time}_{sample_id}.pstats (open with python3 -m pstats, snakeviz, ...), plus a .collapsed file of
+# folded stacks for flamegraph.pl / speedscope with --profile-collapsed. Only the newest --profile-keep
+# profiles are kept. Without --profile-dir no profiler exists and requests don't check for any of this.
+HEADER = "X-Profile"
+QUERY_ARG = "profile"
+TRUTHY = ("1", "true", "yes")
+
+def safe_name(text):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(text))[:64] or "unknown"
+
+class RequestProfiler():
+    def __init__(self, directory, sample_rate=0.0, keep=50, collapsed=False):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.collapsed = collapsed
+        # only one report is profiled at a time; the profiler hooks the interpreter and concurrent
+        # profiles would also slow each other down
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def requested(self, request):
+        return (
+            request.headers.get(HEADER, "").lower() in TRUTHY
+            or request.args.get(QUERY_ARG, "").lower() in TRUTHY
+            or (self.sample_rate > 0 and random.random() < self.sample_rate)
+        )
+
+    # calls func(report) under the profiler (or unprofiled, if another report is being profiled) and
+    # adds the profile's file name to the result; sample_name names the profile if func fails
+    def run(self, func, report, sample_name="unknown"):
+        if not self.lock.acquire(blocking=False):
+            return func(report)
+        profile = cProfile.Profile()
+        result = None
+        try:
+            profile.enable()
+            try:
+                result = func(report)
+            finally:
+                profile.disable()
+        finally:
+            try:
+                path = self.save(profile, result["sample_id"] if result else sample_name)
+            finally:
+                self.lock.release()
+        result["profile"] = os.path.basename(path)
+        return result
+
+    def save(self, profile, sample_id):
+        now = time.time()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"{now % 1:.3f}"[1:]
+        base = os.path.join(self.directory, f"{stamp}_{safe_name(sample_id)}")
+        path = base + ".pstats"
+        try:
+            stats = pstats.Stats(profile)
+            stats.dump_stats(path)
+            if self.collapsed:
+                with open(base + ".collapsed", "w") as f:
+                    for stack, microseconds in collapse_stacks(stats.stats).items():
+                        if microseconds >= 1:
+                            f.write(f"{stack} {int(microseconds)}\n")
+            self.prune()
+        except OSError:
+            log.exception("Couldn't write profile", extra={"path": path})
+        else:
+            log.info("Wrote profile", extra={"sample_id": sample_id, "path": path})
+        return path
+
+    def prune(self):
+        profiles = sorted(glob.glob(os.path.join(self.directory, "*.pstats")), key=os.path.getmtime)
+        for path in profiles[:max(0, len(profiles) - self.keep)]:
+            for old in (path, path[:-len(".pstats")] + ".collapsed"):
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+
+def get_sample_name(vs_json):
+    try:
+        return vs_json["sampleState"]["sampleName"]
+    except (KeyError, TypeError):
+        return "unknown"
+
+def format_function(func):
+    filename, line, name = func
+    if filename == "~":
+        return name # built-ins, e.g. <method 'join' of 'str' objects>
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+# Folded stacks ("outer;inner;leaf microseconds") from cProfile stats. cProfile only keeps caller ->
+# callee edges, not whole stacks, so each function's time is split between the stacks leading to it in
+# proportion to the time its callers spent in it (the same approximation gprof2dot and flameprof make).
+# Branches under min_us are dropped to keep deep call graphs from exploding.
+def collapse_stacks(stats, min_us=1.0):
+    callees = defaultdict(list)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller].append((func, edge[3]))
+    folded = defaultdict(float)
+
+    def walk(func, stack, on_stack, fraction):
+        _, _, tottime, cumtime, _ = stats[func]
+        stack = stack + (format_function(func),)
+        folded[";".join(stack)] += tottime * fraction * 1e6
+        on_stack = on_stack | {func}
+        for callee, edge_cumtime in callees.get(func, ()):
+            callee_cumtime = stats[callee][3]
+            if callee in on_stack or not callee_cumtime:
+                continue
+            share = edge_cumtime * fraction / callee_cumtime
+            if edge_cumtime * fraction * 1e6 >= min_us:
+                walk(callee, stack, on_stack, share)
+
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(func, (), frozenset(), 1.0)
+    return folded
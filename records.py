@@ -0,0 +1,97 @@
+import hashlib
+import marshal
+
+# Compact projections of a VSClinical JSON. VarSeqInfo copies the handful of fields the HL7 messages
+# are built from into these when a report is parsed, so the full (often multi-megabyte) document,
+# with all the fields we never map, doesn't have to stay alive while the messages are rendered and sent.
+# Records are read like the JSON objects they came from (record["pDot"], record.get("vaf")), and a
+# field that was missing from the JSON raises KeyError the same way.
+class Record():
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    # hash of every field of the record (missing ones included, as Ellipsis); records with the same
+    # digest render the same segments. marshal keeps types apart (1, 1.0 and True differ) and is much
+    # cheaper than a canonical JSON dump; version 2 writes equal values the same way regardless of identity
+    def digest(self):
+        values = tuple([getattr(self, name, ...) for name in self.__slots__])
+        return hashlib.sha1(marshal.dumps(values, 2)).digest()
+
+    @classmethod
+    def from_json(cls, obj):
+        record = cls()
+        for name in cls.__slots__:
+            if name in obj:
+                setattr(record, name, obj[name])
+        return record
+
+def project(obj, fields):
+    return {field: obj[field] for field in fields if field in obj} if obj else obj
+
+
+class VariantRecord(Record):
+    __slots__ = (
+        "type", "tags", "biomarkerSummary", "mutation", "geneName", "sequenceOntology",
+        "refAlt", "start", "stop", "pDot", "cDot", "gDot", "hgvsWithGene", "proteinId", "transcriptName",
+        "exon", "assembly", "zygosity", "vaf", "naf", "altReadCount", "readDepth",
+        "sv_vaf", "sv_reads", "sv_len", "projectTableRecordId",
+        # derived from the whole report when the record is made (see VarSeqInfo.get_all_variants)
+        "clin_sig",
+    )
+
+    @classmethod
+    def from_json(cls, obj, clin_sig=None):
+        record = super().from_json(obj)
+        if "tags" in obj and obj["tags"]:
+            record.tags = [project(tag, ("initials",)) for tag in obj["tags"]]
+        if "biomarkerSummary" in obj:
+            record.biomarkerSummary = project(obj["biomarkerSummary"], ("interpretation",))
+        if "mutation" in obj:
+            record.mutation = project(obj["mutation"], ("chr",))
+        record.clin_sig = clin_sig
+        return record
+
+
+# the custom fields VarSeqInfo reads; the report's other custom fields never reach a message
+CUSTOM_FIELDS = (
+    "OrderID", "ProviderID", "ROI_20x", "ROI_250x", "ROI_500x", "Avg_ROI_Coverage",
+    "N_SID", "N_OrderID", "N_DateOrdered", "N_DateReceived",
+)
+
+class HeaderRecord(Record):
+    __slots__ = ("sampleState", "coverageSummary", "customFields", "tumorType", "tumorTypeAbbrev", "biomarkers")
+
+    @classmethod
+    def from_json(cls, obj):
+        record = super().from_json(obj)
+        if "sampleState" in obj:
+            record.sampleState = project(obj["sampleState"], (
+                "sampleName", "mrn", "patientName", "dob", "sex", "orderingPhysician", "dateOrdered", "dateReceived",
+            ))
+        if "customFields" in obj:
+            record.customFields = project(obj["customFields"], CUSTOM_FIELDS)
+        if "coverageSummary" in obj:
+            record.coverageSummary = project(obj["coverageSummary"], (
+                "panelName", "basesAt20x", "basesAt200x", "basesAt500x", "meanDepth",
+            ))
+        # the header only needs the signature biomarkers (TMB, MSI); variant biomarkers become VariantRecords
+        if "biomarkers" in obj:
+            record.biomarkers = [
+                project(biomarker, ("type", "geneName", "quantitativeValue"))
+                for biomarker in obj["biomarkers"] if biomarker["type"] == "SIGNATURE"
+            ]
+        return record
@@ -15,6 +15,71 @@ async function sendJSON(jsonData, url) {
 }
 
 
+// Number of variants whose SR field is looked up at the same time
+const MAX_CONCURRENT_LOOKUPS = 8;
+
+// Calls fn on every item, with at most `limit` calls in flight at once
+async function mapLimit(items, limit, fn) {
+    let next = 0;
+    async function worker() {
+        while (next < items.length) {
+            const item = items[next++];
+            await fn(item);
+        }
+    }
+    const workers = [];
+    for (let i = 0; i < Math.min(limit, items.length); i++) {
+        workers.push(worker());
+    }
+    await Promise.all(workers);
+}
+
+// Sets sv_vaf and sv_reads on every variant from the SR (split reads) field of its project table record.
+// Variants from the same project table share one projectTableSources lookup, and the record lookups run
+// concurrently (the records API takes a single recordId, so there is still one call per variant).
+async function addSVVaf(reportData, api) {
+    const variants = reportData.biomarkers.concat(reportData.germlineVariants.concat(reportData.uncertainVariants));
+    const sourcesByTable = new Map();
+    function getSources(projectTableUuid) {
+        // cache the promise, so concurrent lookups for the same table wait on the same request
+        if (!sourcesByTable.has(projectTableUuid)) {
+            sourcesByTable.set(projectTableUuid, api.projectTableSources({uuid: projectTableUuid, algKey: 'variants'}));
+        }
+        return sourcesByTable.get(projectTableUuid);
+    }
+
+    for (const variant of variants) {
+        variant.sv_vaf = null;
+        variant.sv_reads = null;
+    }
+    await mapLimit(variants, MAX_CONCURRENT_LOOKUPS, async (variant) => {
+        const { projectTableUuid, projectTableRecordId} = variant;
+        if (!projectTableUuid) {
+            return;
+        }
+
+        const sources = await getSources(projectTableUuid);
+        if (sources.length<1){
+            return;
+        }
+        const variantInfoSource = sources[0];
+        const recordSR = await api.projectTableRecords({
+            sourceUrl: variantInfoSource.url,
+            recordId: projectTableRecordId,
+            sampleId: reportData.sampleId,
+            fieldSymbols: ['SR']
+        });
+        const SR = recordSR.find(r => r != null && r.length > 0 && r[0] != null);
+        if(SR != null) {
+            const split_reads = String(SR[0]).split(',');
+            const wt_reads = parseInt(split_reads[0]);
+            const sv_reads = parseInt(split_reads[1]);
+            variant.sv_reads = sv_reads;
+            variant.sv_vaf = sv_reads / (wt_reads + sv_reads);
+        }
+    });
+}
+
 export default {
     description: 'Add SV VAF (if present) to variants, then send an HL7 message to Beaker',
     inputFileNamesTemplate: ['{sampleName}.json'],
@@ -28,34 +93,7 @@ export default {
         const reportData = JSON.parse(sampleReportDataString);
         console.log("Rendering report in Beaker...");
         // Add SV VAF to variants
-        for(const variant of reportData.biomarkers.concat(reportData.germlineVariants.concat(reportData.uncertainVariants))) {
-            variant.sv_vaf = null;
-            variant.sv_reads = null;
-            const { projectTableUuid, projectTableRecordId} = variant;
-            if (!projectTableUuid) {
-                continue;
-            }
-
-            const sources = await api.projectTableSources({uuid: projectTableUuid, algKey: 'variants'});
-            if (sources.length<1){
-                continue;
-            }
-            const variantInfoSource = sources[0];
-            const recordSR = await api.projectTableRecords({
-                sourceUrl: variantInfoSource.url,
-                recordId: projectTableRecordId,
-                sampleId: reportData.sampleId,
-                fieldSymbols: ['SR']
-            });
-            const SR = recordSR.find(r => r != null && r.length > 0 && r[0] != null);
-            if(SR != null) {
-                const split_reads = String(SR[0]).split(',');
-                const wt_reads = parseInt(split_reads[0]);
-                const sv_reads = parseInt(split_reads[1]);
-                variant.sv_reads = sv_reads;
-                variant.sv_vaf = sv_reads / (wt_reads + sv_reads);
-            }
-        }
+        await addSVVaf(reportData, api);
 
         // Send the JSON to a Flask server that will send a corresponding HL7 message to Beaker
         const url = 'http://localhost:5000/receivejson';
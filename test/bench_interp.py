@@ -0,0 +1,38 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+from textwrap import wrap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hl7_text import format_interp
+from synthetic_report import random_interp
+
+# Compares hl7_text.format_interp with the replace() + textwrap implementation it replaced, on
+# multi-paragraph interpretations of increasing length: checks both produce the same output and times them
+parser = argparse.ArgumentParser(description='Benchmark interpretation formatting')
+parser.add_argument('--paragraphs', default='1,5,20,100', help='Comma separated paragraph counts to benchmark')
+parser.add_argument('--samples', type=int, default=20, help='Random interpretations per paragraph count')
+parser.add_argument('--repeat', type=int, default=5, help='Timed repetitions (the best is reported)')
+
+def legacy_format_interp(interp):
+    interp = interp.replace("<p>", "").replace("</p>", "").replace("<em>", "").replace("</em>", "").replace("&nbsp;", " ").replace("–", "-")
+    return '\\.br\\'.join(wrap(interp, 110)).strip()
+
+def main():
+    args = parser.parse_args()
+    rng = random.Random(0)
+    mismatches = 0
+    for paragraphs in [int(p) for p in args.paragraphs.split(",")]:
+        interps = [random_interp(rng, paragraphs, 5) for _ in range(args.samples)]
+        mismatches += sum(legacy_format_interp(i) != format_interp(i) for i in interps)
+        legacy = min(timeit.repeat(lambda: [legacy_format_interp(i) for i in interps], number=1, repeat=args.repeat))
+        new = min(timeit.repeat(lambda: [format_interp(i) for i in interps], number=1, repeat=args.repeat))
+        chars = sum(map(len, interps)) // len(interps)
+        print(f"{paragraphs:>4} paragraphs (~{chars} chars): legacy {legacy / len(interps) * 1e6:.1f}us  new {new / len(interps) * 1e6:.1f}us  ({legacy / new:.2f}x)")
+    print("outputs identical" if not mismatches else f"{mismatches} outputs differ")
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from varseq_info import VarSeqInfo
+from idempotency import LRUCache
+from synthetic_report import generate_report, PANELS
+
+# Times each stage of rendering HL7 messages from synthetic VSClinical JSONs of increasing size and
+# writes the results as JSON, so runs from different versions can be compared with --compare:
+#   python3 test/bench_render.py --output bench_before.json
+#   python3 test/bench_render.py --output bench_after.json --compare bench_before.json
+parser = argparse.ArgumentParser(description='Benchmark VarSeqInfo message rendering')
+parser.add_argument('--sizes', default='10,100,1000,10000', help='Comma separated total variant counts to benchmark')
+parser.add_argument('--panel', default=PANELS[0], choices=PANELS, help='Panel name (decides sort order and whether a normal message is built)')
+parser.add_argument('--interp-paragraphs', type=int, default=3, help='Paragraphs of HTML interpretation per biomarker')
+parser.add_argument('--repeat', type=int, default=5, help='Timed repetitions per stage (the median is reported)')
+parser.add_argument('--output', default='bench_results.json', help='File to write the results to')
+parser.add_argument('--compare', help='Previous results file; stages more than --threshold slower are reported as regressions')
+parser.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown counted as a regression')
+
+# splits a total variant count the way real reports look: a few tier 1 biomarkers, some germline, mostly VUS
+def make_report(size, panel, interp_paragraphs):
+    biomarkers = max(1, size // 10)
+    germline = size // 10
+    return generate_report(biomarkers=biomarkers, germline=germline, uncertain=size - biomarkers - germline,
+                           panel=panel, interp_paragraphs=interp_paragraphs, seed=size)
+
+def time_stage(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {"median_s": statistics.median(timings), "min_s": min(timings), "max_s": max(timings)}
+
+def peak_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def bench_size(size, args):
+    report = make_report(size, args.panel, args.interp_paragraphs)
+    n_variants = len(report["biomarkers"]) + len(report["germlineVariants"]) + len(report["uncertainVariants"])
+    vs_info = VarSeqInfo(copy.deepcopy(report))
+    interps = [v["biomarkerSummary"]["interpretation"] for v in report["biomarkers"] if v.get("biomarkerSummary")]
+
+    def full_message():
+        info = VarSeqInfo(report)
+        return info.get_tumor_msg(), info.get_normal_msg()
+
+    def render_obxs():
+        vs_info.get_tumor_obxs()
+        vs_info.get_normal_obxs()
+
+    # an amended re-submission: the same report with one variant edited (a different one each time),
+    # rendered through a render cache that already holds the original's variants
+    render_cache = LRUCache(4 * n_variants)
+    VarSeqInfo(report, render_cache=render_cache).get_tumor_msg()
+    amendments = iter(range(10 ** 9))
+    def rerender_amended():
+        amended = dict(report, uncertainVariants=list(report["uncertainVariants"]))
+        if amended["uncertainVariants"]:
+            edit = next(amendments)
+            variant = amended["uncertainVariants"][edit % len(amended["uncertainVariants"])]
+            amended["uncertainVariants"][edit % len(amended["uncertainVariants"])] = dict(variant, cDot=f"{variant['cDot']} ({edit})")
+        info = VarSeqInfo(amended, render_cache=render_cache)
+        return info.get_tumor_msg(), info.get_normal_msg()
+
+    stages = {
+        "construction": time_stage(lambda: VarSeqInfo(report), args.repeat),
+        "sort_variants": time_stage(lambda: vs_info.get_all_variants(report), args.repeat),
+        "render_obxs": time_stage(render_obxs, args.repeat),
+        "format_interp": time_stage(lambda: [vs_info.format_interp(i) for i in interps], args.repeat),
+        "full_message": time_stage(full_message, args.repeat),
+        "rerender_amended": time_stage(rerender_amended, args.repeat),
+    }
+    tumor_msg, normal_msg = full_message()
+    full = stages["full_message"]["median_s"]
+    return {
+        "variants": n_variants,
+        "interpretations": len(interps),
+        "input_bytes": len(json.dumps(report)),
+        "output_bytes": len(tumor_msg) + len(normal_msg),
+        "stages": stages,
+        "variants_per_s": n_variants / full if full else None,
+        "reports_per_s": 1 / full if full else None,
+        "peak_memory_bytes": peak_memory(full_message),
+    }
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def compare(results, previous, threshold):
+    regressions = []
+    for size, result in results["sizes"].items():
+        old = previous["sizes"].get(size)
+        if not old:
+            continue
+        for stage, timing in result["stages"].items():
+            old_timing = old["stages"].get(stage)
+            if old_timing and old_timing["median_s"] and timing["median_s"] > old_timing["median_s"] * (1 + threshold):
+                regressions.append(f"{size} variants, {stage}: {old_timing['median_s'] * 1000:.2f}ms -> {timing['median_s'] * 1000:.2f}ms")
+    return regressions
+
+def main():
+    args = parser.parse_args()
+    results = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "panel": args.panel,
+        "sizes": {},
+    }
+    for size in [int(s) for s in args.sizes.split(",")]:
+        result = bench_size(size, args)
+        results["sizes"][str(size)] = result
+        timings = "  ".join(f"{stage} {t['median_s'] * 1000:.2f}ms" for stage, t in result["stages"].items())
+        print(f"{size:>6} variants: {timings}  {result['variants_per_s']:.0f} variants/s  peak {result['peak_memory_bytes'] / 2**20:.2f} MiB")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+// Times the SV VAF enrichment of report_cancer.js against a mocked VarSeq `api` (every call resolves
+// after --latency ms) and checks that it sets the same sv_vaf / sv_reads as the old sequential loop:
+//   node test/bench_report_script.mjs --variants 500 --tables 3 --latency 5
+import assert from 'node:assert/strict';
+import { readFile } from 'node:fs/promises';
+import { parseArgs } from 'node:util';
+
+const { values: args } = parseArgs({
+    options: {
+        variants: { type: 'string', default: '500' },
+        tables: { type: 'string', default: '3' },
+        latency: { type: 'string', default: '5' },
+        seed: { type: 'string', default: '1' },
+    },
+});
+const variantCount = parseInt(args.variants);
+const tableCount = parseInt(args.tables);
+const latency = parseFloat(args.latency);
+
+// report_cancer.js is a VarSeq script (an ES module without a package.json), so it is loaded from source
+const scriptUrl = new URL('../report_cancer.js', import.meta.url);
+const source = await readFile(scriptUrl, 'utf8');
+const { default: script } = await import('data:text/javascript,' + encodeURIComponent(source));
+
+// small deterministic PRNG, so both runs see the same report
+let state;
+function random() {
+    state = (state * 1103515245 + 12345) % 2147483648;
+    return state / 2147483648;
+}
+
+// variants spread over the tables; some aren't in a project table, some tables have no sources and
+// some records have no SR
+function makeReport() {
+    state = parseInt(args.seed);
+    const variants = [];
+    for (let i = 0; i < variantCount; i++) {
+        const table = Math.floor(random() * (tableCount + 1));
+        variants.push(table === tableCount ? {} : { projectTableUuid: `table${table}`, projectTableRecordId: i });
+    }
+    const third = Math.floor(variantCount / 3);
+    return {
+        sampleId: 7,
+        biomarkers: variants.slice(0, third),
+        germlineVariants: variants.slice(third, 2 * third),
+        uncertainVariants: variants.slice(2 * third),
+    };
+}
+
+function makeApi() {
+    const calls = { projectTableSources: 0, projectTableRecords: 0 };
+    const delay = (value) => new Promise(resolve => setTimeout(() => resolve(value), latency));
+    return {
+        calls,
+        projectTableSources({ uuid }) {
+            calls.projectTableSources++;
+            return delay(uuid === 'table0' && tableCount > 1 ? [] : [{ url: `source/${uuid}` }]);
+        },
+        projectTableRecords({ recordId }) {
+            calls.projectTableRecords++;
+            if (recordId % 7 === 0) {
+                return delay([[null]]);
+            }
+            return delay([[`${recordId % 50},${recordId % 13 + 1}`]]);
+        },
+    };
+}
+
+// the enrichment loop as it was before lookups were cached and run concurrently
+async function sequentialSVVaf(reportData, api) {
+    for (const variant of reportData.biomarkers.concat(reportData.germlineVariants.concat(reportData.uncertainVariants))) {
+        variant.sv_vaf = null;
+        variant.sv_reads = null;
+        const { projectTableUuid, projectTableRecordId } = variant;
+        if (!projectTableUuid) {
+            continue;
+        }
+        const sources = await api.projectTableSources({ uuid: projectTableUuid, algKey: 'variants' });
+        if (sources.length < 1) {
+            continue;
+        }
+        const recordSR = await api.projectTableRecords({
+            sourceUrl: sources[0].url,
+            recordId: projectTableRecordId,
+            sampleId: reportData.sampleId,
+            fieldSymbols: ['SR']
+        });
+        const SR = recordSR.find(r => r != null && r.length > 0 && r[0] != null);
+        if (SR != null) {
+            const split_reads = String(SR[0]).split(',');
+            const wt_reads = parseInt(split_reads[0]);
+            const sv_reads = parseInt(split_reads[1]);
+            variant.sv_reads = sv_reads;
+            variant.sv_vaf = sv_reads / (wt_reads + sv_reads);
+        }
+    }
+    return reportData;
+}
+
+// runs render() with the report as its input, with fetch stubbed out so nothing is posted to the server
+async function renderScript(reportData, api) {
+    const fetch = globalThis.fetch;
+    globalThis.fetch = async () => ({ ok: true, json: async () => ({}) });
+    const log = console.log;
+    console.log = () => {};
+    try {
+        const [output] = await script.render({ templatedInputs: [JSON.stringify(reportData)], api });
+        // let the (unawaited) POST to the server settle while its log is still silenced
+        await new Promise(resolve => setTimeout(resolve, 0));
+        return JSON.parse(output);
+    } finally {
+        globalThis.fetch = fetch;
+        console.log = log;
+    }
+}
+
+async function time(label, run) {
+    const api = makeApi();
+    const start = performance.now();
+    const result = await run(makeReport(), api);
+    const elapsed = performance.now() - start;
+    console.log(`${label.padEnd(12)} ${elapsed.toFixed(0).padStart(7)} ms  ` +
+        `projectTableSources=${api.calls.projectTableSources} projectTableRecords=${api.calls.projectTableRecords}`);
+    return { result, elapsed };
+}
+
+console.log(`${variantCount} variants, ${tableCount} project tables, ${latency} ms per API call`);
+const before = await time('sequential', sequentialSVVaf);
+const after = await time('concurrent', renderScript);
+for (const kind of ['biomarkers', 'germlineVariants', 'uncertainVariants']) {
+    assert.deepEqual(
+        after.result[kind].map(v => [v.sv_vaf, v.sv_reads]),
+        before.result[kind].map(v => [v.sv_vaf, v.sv_reads]),
+        `sv_vaf / sv_reads differ in ${kind}`);
+}
+console.log(`identical sv_vaf / sv_reads, ${(before.elapsed / after.elapsed).toFixed(1)}x faster`);
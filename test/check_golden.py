@@ -0,0 +1,64 @@
+import argparse
+import glob
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from varseq_info import VarSeqInfo
+from idempotency import LRUCache
+
+# Renders every test/golden/*.json and compares the messages byte for byte with the
+# .tumor.hl7 / .normal.hl7 files next to it. Rendering changes that are meant to be output-neutral
+# must pass this; after an intentional output change, rewrite the expected files with --update.
+# Every report is also rendered through a render cache shared by all of them, once while the cache is
+# filling and once from a warm cache, which must give the same messages.
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+GOLDEN_DATE_SENT = "20240101"
+GOLDEN_CONTROL_ID = "1"
+
+parser = argparse.ArgumentParser(description='Check rendered HL7 messages against the golden files')
+parser.add_argument('--update', action='store_true', help='Rewrite the expected messages instead of checking them')
+
+def render(path, render_cache=None):
+    with open(path, "r") as f:
+        vs_info = VarSeqInfo(json.load(f), next_control_id=lambda: GOLDEN_CONTROL_ID, render_cache=render_cache)
+    vs_info.date_sent = GOLDEN_DATE_SENT
+    return {"tumor": vs_info.get_tumor_msg(), "normal": vs_info.get_normal_msg()}
+
+def check(path, messages, note=""):
+    failures = 0
+    for kind, msg in messages.items():
+        expected_path = path[:-len(".json")] + f".{kind}.hl7"
+        with open(expected_path, "r", newline="") as f:
+            expected = f.read()
+        if msg != expected:
+            failures += 1
+            # report the first differing segment rather than dumping whole messages
+            for i, (got, want) in enumerate(zip(msg.split("\r"), expected.split("\r"))):
+                if got != want:
+                    break
+            print(f"MISMATCH {os.path.basename(expected_path)}{note} segment {i}:\n  expected {want!r}\n  got      {got!r}")
+    return failures
+
+def main():
+    args = parser.parse_args()
+    failures = 0
+    paths = sorted(glob.glob(os.path.join(GOLDEN_DIR, "*.json")))
+    if args.update:
+        for path in paths:
+            for kind, msg in render(path).items():
+                with open(path[:-len(".json")] + f".{kind}.hl7", "w", newline="") as f:
+                    f.write(msg)
+        return 0
+    render_cache = LRUCache(1000000)
+    for path in paths:
+        failures += check(path, render(path))
+        failures += check(path, render(path, render_cache), " (filling render cache)")
+    for path in paths:
+        failures += check(path, render(path, render_cache), " (from render cache)")
+    print(f"{len(paths)} golden reports match" if not failures else f"{failures} golden message(s) differ")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from synthetic_report import generate_report, PANELS
+from mllp_stub_server import MLLPStubServer
+
+# End-to-end load test of the HL7 server, entirely on localhost: starts an MLLP stub interface
+# (mllp_stub_server.py) and varseq_hl7.py pointed at it, POSTs synthetic VSClinical JSONs to /receivejson
+# at a target rate and concurrency, then follows every tracking ID until its messages are delivered.
+# The --distinct reports repeat, so they are POSTed with ?force=1 to be converted and sent every time.
+#   python3 test/load_test.py --requests 500 --rate 50 --concurrency 16 --stub-latency 20 --stub-error-rate 0.02
+# Reports p50/p95/p99 latency of the POST itself and end to end (POST until every message of the report is
+# acknowledged), messages delivered per second, and error rates. Pass --url to test an already running
+# server instead (pointed at a stub you started yourself).
+parser = argparse.ArgumentParser(description='Load test the HL7 server against a local MLLP stub')
+parser.add_argument('--url', help='Base URL of a running server; by default one is started against an in-process stub')
+parser.add_argument('--requests', default=200, type=int, help='Number of reports to POST')
+parser.add_argument('--rate', default=20.0, type=float, help='Target POSTs per second (0 for as fast as --concurrency allows)')
+parser.add_argument('--concurrency', default=8, type=int, help='Maximum POSTs in flight')
+parser.add_argument('--distinct', default=20, type=int, help='Number of different synthetic reports to cycle through')
+parser.add_argument('--variants', default=50, type=int, help='Variants per synthetic report')
+parser.add_argument('--panel', default=PANELS[0], choices=PANELS, help='Panel of the synthetic reports')
+parser.add_argument('--drain-timeout', default=120.0, type=float, help='Seconds to wait after the last POST for deliveries to finish')
+parser.add_argument('--serve', default='prod', choices=['dev', 'prod'], help='Serve mode of the started server')
+parser.add_argument('--workers', default=2, type=int, help='Worker processes of the started server (prod mode)')
+parser.add_argument('--send-window', default=8, type=int, help='--send-window of the started server')
+parser.add_argument('--retry-backoff', default=0.5, type=float, help='--retry-backoff of the started server')
+parser.add_argument('--stub-latency', default=0.0, type=float, help='Milliseconds the stub waits before each ACK')
+parser.add_argument('--stub-jitter', default=0.0, type=float, help='Random extra milliseconds per ACK')
+parser.add_argument('--stub-error-rate', default=0.0, type=float, help='Fraction of messages the stub answers with AE')
+parser.add_argument('--stub-reject-rate', default=0.0, type=float, help='Fraction of messages the stub answers with AR')
+parser.add_argument('--stub-drop-rate', default=0.0, type=float, help='Fraction of messages the stub drops the connection on')
+parser.add_argument('--stub-read-delay', default=0.0, type=float, help='Milliseconds the stub pauses before each socket read')
+parser.add_argument('--dedup', action='store_true', help="Let the server answer repeated reports as duplicates instead of POSTing with ?force=1")
+parser.add_argument('--output', help='File to write the results to as JSON')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def http(method, url, body=None, timeout=60):
+    request = urllib.request.Request(url, data=body, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+def start_server(args, stub, workdir):
+    port = free_port()
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "varseq_hl7.py"),
+        "--interface-host", stub.host, "--interface-port", str(stub.port), "--flask-port", str(port),
+        "--serve", args.serve, "--workers", str(args.workers), "--send-window", str(args.send_window),
+        "--retry-backoff", str(args.retry_backoff), "--outbox", os.path.join(workdir, "outbox.sqlite3"),
+    ]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}, see {log.name}")
+        try:
+            http("GET", url + "/status/ready", timeout=1)
+            return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Server didn't start within 30s, see {log.name}")
+
+# split like bench_render.py: a few tier 1 biomarkers, some germline, mostly VUS
+def make_reports(args):
+    biomarkers = max(1, args.variants // 10)
+    germline = args.variants // 10
+    return [
+        json.dumps(generate_report(biomarkers=biomarkers, germline=germline, uncertain=max(0, args.variants - biomarkers - germline),
+                                   panel=args.panel, seed=seed)).encode()
+        for seed in range(args.distinct)
+    ]
+
+# POSTs every report at its scheduled time; returns [(start, end, http status, tracking ID)]
+def run_load(args, url, reports):
+    results = [None] * args.requests
+
+    def post(i):
+        start = time.time()
+        try:
+            status, body = http("POST", url + ("/receivejson" if args.dedup else "/receivejson?force=1"), reports[i % len(reports)])
+        except OSError:
+            status, body = None, None
+        results[i] = (start, time.time(), status, body and body.get("tracking_id"))
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        begin = time.time()
+        # a semaphore keeps submissions from queueing up behind slow requests, so --rate is an upper bound
+        slots = threading.Semaphore(args.concurrency)
+        for i in range(args.requests):
+            if args.rate:
+                delay = begin + i / args.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            executor.submit(post, i).add_done_callback(lambda _: slots.release())
+    return results
+
+# a superseded message was replaced by a newer submission of its sample before it was sent, and never will be
+FINAL_STATUSES = ("sent", "failed", "superseded")
+
+# follows every tracking ID until its messages are sent, failed or superseded; returns {tracking ID: status}
+def drain(url, tracking_ids, timeout):
+    statuses = {}
+    waiting = set(tracking_ids)
+    deadline = time.time() + timeout
+    while waiting and time.time() < deadline:
+        for tracking_id in list(waiting):
+            code, status = http("GET", f"{url}/status/{tracking_id}")
+            if code == 200:
+                statuses[tracking_id] = status
+                if all(m["status"] in FINAL_STATUSES for m in status["messages"]):
+                    waiting.discard(tracking_id)
+        if waiting:
+            time.sleep(0.5)
+    return statuses
+
+def percentiles(values):
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] * 1000
+
+    return {"p50_ms": rank(50), "p95_ms": rank(95), "p99_ms": rank(99), "max_ms": values[-1] * 1000}
+
+def summarize(results, statuses, stub_stats):
+    posted = [r for r in results if r]
+    # 200 is a duplicate answered with an earlier submission (only with --dedup)
+    accepted = [r for r in posted if r[2] in (200, 202)]
+    messages = [m for s in statuses.values() for m in s["messages"]]
+    sent = [m for m in messages if m["status"] == "sent"]
+    superseded = sum(m["status"] == "superseded" for m in messages)
+    end_to_end = []
+    for start, _, code, tracking_id in accepted:
+        if code != 202:
+            continue
+        status = statuses.get(tracking_id)
+        delivered = [m for m in status["messages"] if m["status"] == "sent"] if status else []
+        if delivered and all(m["status"] in ("sent", "superseded") for m in status["messages"]):
+            end_to_end.append(max(m["updated"] for m in delivered) - start)
+    first_post = min((r[0] for r in posted), default=0)
+    last_delivery = max((m["updated"] for m in sent), default=first_post)
+    expected = sum(len(s["messages"]) for s in statuses.values()) - superseded
+    return {
+        "requests": len(results),
+        "accepted": len(accepted),
+        "duplicates": sum(r[2] == 200 for r in accepted),
+        "http_error_rate": 1 - len(accepted) / len(results) if results else 0,
+        "post_latency": percentiles([end - start for start, end, _, _ in accepted]),
+        "end_to_end_latency": percentiles(end_to_end),
+        "messages": expected,
+        "messages_superseded": superseded,
+        "messages_sent": len(sent),
+        "messages_failed": sum(m["status"] == "failed" for m in messages),
+        "messages_undelivered": expected - len(sent),
+        "messages_retried": sum(m["attempts"] > 1 for m in messages),
+        "delivery_error_rate": 1 - len(sent) / expected if expected else 0,
+        "messages_per_s": len(sent) / (last_delivery - first_post) if last_delivery > first_post else None,
+        "end_to_end_mean_ms": statistics.mean(end_to_end) * 1000 if end_to_end else None,
+        "stub": stub_stats,
+    }
+
+def print_summary(summary):
+    def line(name, p):
+        if p["p50_ms"] is None:
+            return f"{name}: no samples"
+        return f"{name}: p50 {p['p50_ms']:.1f}ms  p95 {p['p95_ms']:.1f}ms  p99 {p['p99_ms']:.1f}ms  max {p['max_ms']:.1f}ms"
+    print(f"{summary['accepted']}/{summary['requests']} POSTs accepted ({summary['duplicates']} as duplicates, {summary['http_error_rate']:.1%} errors)")
+    print(line("POST latency", summary["post_latency"]))
+    print(line("End-to-end latency", summary["end_to_end_latency"]))
+    rate = summary["messages_per_s"]
+    print(f"{summary['messages_sent']}/{summary['messages']} messages delivered"
+          + (f", {rate:.1f} messages/s" if rate else "")
+          + f"; {summary['messages_superseded']} superseded, {summary['messages_retried']} retried, {summary['messages_failed']} failed,"
+          + f" {summary['messages_undelivered']} undelivered ({summary['delivery_error_rate']:.1%} delivery errors)")
+    if summary["stub"]:
+        print("Stub: " + " ".join(f"{name}={value}" for name, value in summary["stub"].items()))
+
+def main():
+    args = parser.parse_args()
+    reports = make_reports(args)
+    stub = process = None
+    with tempfile.TemporaryDirectory(prefix="varseq2hl7_load_") as workdir:
+        try:
+            url = args.url
+            if not url:
+                stub = MLLPStubServer(latency=args.stub_latency / 1000, jitter=args.stub_jitter / 1000,
+                                      error_rate=args.stub_error_rate, reject_rate=args.stub_reject_rate,
+                                      drop_rate=args.stub_drop_rate, read_delay=args.stub_read_delay / 1000).start()
+                process, url = start_server(args, stub, workdir)
+            print(f"POSTing {args.requests} reports to {url} at {args.rate or 'max'}/s with concurrency {args.concurrency}")
+            results = run_load(args, url, reports)
+            tracking_ids = [r[3] for r in results if r and r[3]]
+            statuses = drain(url, tracking_ids, args.drain_timeout)
+            summary = summarize(results, statuses, stub.stats() if stub else None)
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+            if stub:
+                stub.stop()
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": summary}, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import argparse
+import random
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+# A local stand-in for the Beaker interface: accepts MLLP connections, decodes every framed message and
+# answers it with an ACK for its MSH-10. The answer and the connection's behaviour are configurable, so
+# delivery can be exercised and benchmarked on localhost:
+#   python3 test/mllp_stub_server.py --port 2575 --latency 50 --error-rate 0.05 --drop-rate 0.01
+# It can also be started in-process (MLLPStubServer(...).start(), see load_test.py) and asked for counts of
+# what it received and answered.
+SB = b"\x0b"
+EB = b"\x1c"
+CR = b"\r"
+
+parser = argparse.ArgumentParser(description='Stand-in MLLP interface server returning configurable ACKs')
+parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+parser.add_argument('--port', default=2575, type=int, help='Port to listen on')
+parser.add_argument('--error-rate', default=0.0, type=float, help='Fraction of messages answered with AE')
+parser.add_argument('--reject-rate', default=0.0, type=float, help='Fraction of messages answered with AR')
+parser.add_argument('--latency', default=0.0, type=float, help='Milliseconds to wait before answering each message')
+parser.add_argument('--jitter', default=0.0, type=float, help='Random extra milliseconds (0 to this) added to --latency')
+parser.add_argument('--drop-rate', default=0.0, type=float, help='Fraction of messages that get no ACK; the connection is closed instead')
+parser.add_argument('--read-delay', default=0.0, type=float, help='Milliseconds to pause before every read from a connection (a slow reader)')
+parser.add_argument('--read-size', default=65536, type=int, help='Bytes read from the socket at a time (small values with --read-delay make reads slow)')
+parser.add_argument('--rewrite-control-ids', action='store_true', help='Answer with a control ID of its own in MSA-2 instead of the message\'s MSH-10, like an engine that rewrites it')
+parser.add_argument('--seed', default=None, type=int, help='Random seed for the error/reject/drop decisions')
+parser.add_argument('--stats-interval', default=10.0, type=float, help='Seconds between printed counters (0 to disable)')
+
+def get_control_id(message):
+    header = message.split("\r", 1)[0]
+    fields = header.split(header[3:4] or "|")
+    return fields[9] if len(fields) > 9 else ""
+
+def make_ack(message, code, control_id=None):
+    control_id = get_control_id(message) if control_id is None else control_id
+    date = time.strftime("%Y%m%d%H%M%S")
+    text = {"AA": "", "AE": "Application error", "AR": "Application reject"}[code]
+    return f"MSH|^~\\&|BEAKER||RRH||{date}||ACK|ACK{control_id}|P|2.3\rMSA|{code}|{control_id}|{text}\r"
+
+
+class StubHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        stub = self.server.stub
+        stub.count("connections")
+        with stub.lock:
+            stub.sockets.add(self.request)
+        try:
+            self.serve(stub)
+        finally:
+            with stub.lock:
+                stub.sockets.discard(self.request)
+
+    def serve(self, stub):
+        buffer = b""
+        while True:
+            if stub.read_delay:
+                time.sleep(stub.read_delay)
+            try:
+                data = self.request.recv(stub.read_size)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            end = buffer.find(EB + CR)
+            while end != -1:
+                frame, buffer = buffer[:end], buffer[end + 2:]
+                message = frame[frame.find(SB) + 1:].decode("utf-8", errors="replace")
+                if not stub.answer(self.request, message):
+                    stub.count("dropped")
+                    self.request.close()
+                    return
+                end = buffer.find(EB + CR)
+
+
+class MLLPStubServer():
+    def __init__(self, host="127.0.0.1", port=0, error_rate=0.0, reject_rate=0.0, latency=0.0, jitter=0.0,
+                 drop_rate=0.0, read_delay=0.0, read_size=65536, rewrite_control_ids=False, seed=None):
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        # all times in seconds here; the command line takes milliseconds
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.read_delay = read_delay
+        self.read_size = read_size
+        self.rewrite_control_ids = rewrite_control_ids
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "received": 0, "AA": 0, "AE": 0, "AR": 0, "dropped": 0}
+        # (control ID, code) of every message received, code None when it was dropped
+        self.answers = []
+        self.sockets = set()
+        self.server = socketserver.ThreadingTCPServer((host, port), StubHandler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.stub = self
+        self.host, self.port = self.server.server_address
+        self.thread = None
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def decide(self):
+        with self.lock:
+            roll = self.rng.random()
+            delay = self.latency + self.rng.uniform(0, self.jitter) if self.jitter else self.latency
+        if roll < self.drop_rate:
+            return None, delay
+        roll -= self.drop_rate
+        if roll < self.error_rate:
+            return "AE", delay
+        roll -= self.error_rate
+        if roll < self.reject_rate:
+            return "AR", delay
+        return "AA", delay
+
+    # returns False when the message should be dropped (connection closed without an ACK)
+    def answer(self, sock, message):
+        self.count("received")
+        code, delay = self.decide()
+        with self.lock:
+            self.answers.append((get_control_id(message), code))
+            answered = len(self.answers)
+        if delay:
+            time.sleep(delay)
+        if code is None:
+            return False
+        ack = make_ack(message, code, f"STUB{answered}" if self.rewrite_control_ids else None)
+        try:
+            sock.sendall(SB + ack.encode("utf-8") + EB + CR)
+        except OSError:
+            return False
+        self.count(code)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    # closes every open connection, like an engine dropping idle sockets
+    def close_connections(self):
+        with self.lock:
+            sockets = list(self.sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mllp-stub", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main():
+    args = parser.parse_args()
+    stub = MLLPStubServer(args.host, args.port, error_rate=args.error_rate, reject_rate=args.reject_rate,
+                          latency=args.latency / 1000, jitter=args.jitter / 1000, drop_rate=args.drop_rate,
+                          read_delay=args.read_delay / 1000, read_size=args.read_size,
+                          rewrite_control_ids=args.rewrite_control_ids, seed=args.seed).start()
+    print(f"MLLP stub listening on {stub.host}:{stub.port}")
+    try:
+        while True:
+            time.sleep(args.stats_interval or 3600)
+            if args.stats_interval:
+                print(" ".join(f"{name}={value}" for name, value in stub.stats().items()), flush=True)
+    except KeyboardInterrupt:
+        stub.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
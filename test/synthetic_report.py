@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mappings import SEQ_ONTOLOGY_MAP
+
+# generates synthetic VSClinical JSONs shaped like the ones report_cancer.js sends us,
+# for benchmarking and load testing without real patient data
+PANELS = ["UCLA Pan-Cancer All v1", "Pan-Cancer Solid Tumor Exon Targets", "UCLA Heme v2", "GOAL 221 Heme Exon Targets"]
+GENES = ["TP53", "KRAS", "EGFR", "BRAF", "PIK3CA", "APC", "PTEN", "NRAS", "IDH1", "IDH2", "FLT3", "NPM1",
+         "DNMT3A", "TET2", "ASXL1", "RUNX1", "BRCA1", "BRCA2", "ATM", "CHEK2", "ARID1A", "KMT2D", "NOTCH1", "JAK2"]
+BASES = "ACGT"
+AMINO_ACIDS = ["Ala", "Arg", "Asn", "Asp", "Cys", "Gln", "Glu", "Gly", "His", "Ile", "Leu", "Lys", "Met", "Phe", "Pro", "Ser", "Thr", "Trp", "Tyr", "Val"]
+INTERP_SENTENCES = [
+    "This variant has been reported in multiple tumor types and is considered an oncogenic driver.",
+    "Functional studies have demonstrated that this alteration results in constitutive activation of the kinase domain.",
+    "In the <em>Catalogue of Somatic Mutations in Cancer</em> (COSMIC), this variant is observed in 1,203 samples.",
+    "Patients harboring this alteration may be eligible for targeted therapy&nbsp;within clinical trials.",
+    "The variant is located in a well-characterized hotspot region – see NCCN guidelines for details.",
+    "Germline testing is recommended to confirm whether this variant is constitutional or acquired.",
+    "Population frequency databases (gnomAD) report this allele at a frequency below 0.01%.",
+]
+
+
+def random_interp(rng, paragraphs, sentences_per_paragraph):
+    return "".join(
+        "<p>" + " ".join(rng.choice(INTERP_SENTENCES) for _ in range(sentences_per_paragraph)) + "</p>"
+        for _ in range(paragraphs)
+    )
+
+
+def random_variant(rng, tag, interp_paragraphs, is_structural=False):
+    gene = rng.choice(GENES)
+    start = rng.randint(10_000, 200_000_000)
+    ref_len, alt_len = rng.choice([(1, 1), (1, 1), (1, 1), (1, 0), (0, 1), (3, 0)])
+    ref = "".join(rng.choice(BASES) for _ in range(ref_len)) or "-"
+    alt = "".join(rng.choice(BASES) for _ in range(alt_len)) or "-"
+    stop = start if ref == "-" else start + ref_len
+    codon = rng.randint(1, 1500)
+    c_pos = codon * 3 - rng.randint(0, 2)
+    has_pdot = rng.random() > 0.1
+    pdot = f"p.{rng.choice(AMINO_ACIDS)}{codon}{rng.choice(AMINO_ACIDS)}" if has_pdot else ""
+    cdot = f"c.{c_pos}{ref if ref != '-' else ''}>{alt if alt != '-' else ''}"
+    transcript = f"NM_{rng.randint(100000, 999999)}.{rng.randint(1, 9)}"
+    vaf = round(rng.uniform(0.02, 0.98), 4)
+    depth = rng.randint(100, 2000)
+    variant = {
+        "type": "VARIANT",
+        "geneName": gene,
+        "tags": [{"initials": tag}] if tag else [],
+        "biomarkerSummary": {"interpretation": random_interp(rng, interp_paragraphs, 4)} if interp_paragraphs else None,
+        "mutation": {"chr": str(rng.randint(1, 22))} if rng.random() > 0.05 else None,
+        "naf": round(rng.uniform(0.0, 0.6), 4) if rng.random() > 0.2 else None,
+        "sequenceOntology": rng.choice(list(SEQ_ONTOLOGY_MAP)),
+        "refAlt": f"{ref}/{alt}",
+        "start": start,
+        "stop": stop,
+        "pDot": pdot,
+        "cDot": cdot,
+        "gDot": f"NC_0000{rng.randint(10, 24)}.{rng.randint(9, 11)}:g.{start + 1}{ref}>{alt}",
+        "hgvsWithGene": f"{transcript}({gene}):{cdot}",
+        "proteinId": f"NP_{rng.randint(100000, 999999)}.{rng.randint(1, 9)}",
+        "transcriptName": transcript,
+        "exon": f"{rng.randint(1, 30)}/{rng.randint(30, 40)}",
+        "assembly": "GRCh38",
+        "vaf": vaf if rng.random() > 0.1 else None,
+        "altReadCount": int(depth * vaf),
+        "readDepth": depth,
+        "zygosity": rng.choice(["Heterozygous", "Homozygous", None]),
+        "projectTableUuid": f"{rng.getrandbits(128):032x}",
+        "projectTableRecordId": rng.randint(0, 10_000_000),
+        "sv_vaf": None,
+        "sv_reads": None,
+    }
+    if is_structural:
+        variant["sv_vaf"] = round(rng.uniform(0.05, 0.9), 4)
+        variant["sv_reads"] = rng.randint(5, 500)
+        variant["sv_len"] = rng.randint(50, 50_000)
+    return variant
+
+
+def random_date(rng):
+    return f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/{rng.randint(1940, 2024)}"
+
+
+def generate_report(biomarkers=5, germline=2, uncertain=10, panel=PANELS[0], interp_paragraphs=2,
+                    signatures=True, new_coverage=True, structural_fraction=0.05, seed=0):
+    rng = random.Random(seed)
+    sample_name = f"{rng.randint(10, 99)}-{rng.randint(100000, 999999)}R{rng.choice(['', '1', '2'])}"
+
+    def variants(count, tags, interp):
+        return [
+            random_variant(rng, rng.choice(tags), interp, rng.random() < structural_fraction)
+            for _ in range(count)
+        ]
+
+    biomarker_list = variants(biomarkers, ["SM"], interp_paragraphs)
+    if signatures:
+        biomarker_list.append({"type": "SIGNATURE", "geneName": "TMB", "quantitativeValue": round(rng.uniform(0, 50), 1)})
+        biomarker_list.append({"type": "SIGNATURE", "geneName": "MSI", "quantitativeValue": rng.choice(["Stable", "High"])})
+    custom_fields = {
+        "OrderID": str(rng.randint(10_000_000, 99_999_999)),
+        "ProviderID": rng.randint(1000, 999999),
+        "N_SID": f"{rng.randint(10, 99)}-{rng.randint(100000, 999999)}R",
+        "N_OrderID": str(rng.randint(10_000_000, 99_999_999)),
+        "N_DateOrdered": f"{random_date(rng)} 10:15",
+        "N_DateReceived": f"{random_date(rng)} 08:30",
+    }
+    if new_coverage:
+        custom_fields.update({
+            "ROI_20x": str(rng.uniform(95, 100)),
+            "ROI_250x": str(rng.uniform(80, 99)),
+            "ROI_500x": str(rng.uniform(50, 90)),
+            "Avg_ROI_Coverage": str(rng.uniform(400, 1500)),
+        })
+    return {
+        "sampleId": rng.randint(1, 1000),
+        "sampleState": {
+            "sampleName": sample_name,
+            "mrn": rng.randint(1, 9_999_999),
+            "patientName": f"Doe{rng.randint(1, 999)}, Jane (000{rng.randint(1000, 9999)})",
+            "dob": random_date(rng),
+            "sex": rng.choice(["Female", "Male", "Unknown"]),
+            "orderingPhysician": f"Smith{rng.randint(1, 99)}, John",
+            "dateOrdered": random_date(rng),
+            "dateReceived": random_date(rng),
+        },
+        "coverageSummary": {
+            "panelName": panel,
+            "basesAt20x": rng.uniform(95, 100),
+            "basesAt200x": rng.uniform(80, 99),
+            "basesAt500x": rng.uniform(50, 90),
+            "meanDepth": rng.uniform(400, 1500),
+        },
+        "customFields": custom_fields,
+        "tumorType": "Non-Small Cell Lung Cancer",
+        "tumorTypeAbbrev": "NSCLC",
+        "biomarkers": biomarker_list,
+        "germlineVariants": variants(germline, ["GL"], 0),
+        "uncertainVariants": variants(uncertain, ["SM", "GL", None], 0),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic VSClinical JSON')
+    parser.add_argument('--biomarkers', type=int, default=5, help='Number of tier 1 biomarker variants')
+    parser.add_argument('--germline', type=int, default=2, help='Number of germline variants')
+    parser.add_argument('--uncertain', type=int, default=10, help='Number of uncertain (VUS) variants')
+    parser.add_argument('--panel', default=PANELS[0], choices=PANELS, help='Panel name written to coverageSummary')
+    parser.add_argument('--interp-paragraphs', type=int, default=2, help='Paragraphs of HTML interpretation per biomarker')
+    parser.add_argument('--old-coverage', action='store_true', help='Omit the ROI_* custom fields')
+    parser.add_argument('--no-signatures', action='store_true', help='Omit TMB/MSI signature biomarkers')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    report = generate_report(args.biomarkers, args.germline, args.uncertain, args.panel, args.interp_paragraphs,
+                             not args.no_signatures, not args.old_coverage, seed=args.seed)
+    print(json.dumps(report, indent=2))
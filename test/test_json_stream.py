@@ -0,0 +1,74 @@
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from json_stream import iter_json_objects, JSONStreamError
+from synthetic_report import generate_report
+
+# Splitting a stream of JSONs (json_stream.py) checked against json itself, read a few bytes at a time so
+# strings, escapes and nesting are cut at every position. Runs with python3 -m pytest test/.
+
+DOCUMENTS = [
+    {"sample": "S1", "variants": [{"gene": "TP53", "notes": "braces { in } strings [ and ] too"}], "empty": {}},
+    {"quote": "say \"hi\"", "backslash": "C:\\path\\", "unicode": "\u00e9\u2603 \U0001f600", "control": "a\tb\nc"},
+    {"escaped_end": "\\", "escaped_quote_end": "\"", "nested": [[{"a": [1, {"b": None}]}], []], "number": -1.5e3},
+    {},
+]
+
+def split(data, chunk_size):
+    return [json.loads(document) for document in iter_json_objects(io.BytesIO(data), chunk_size)]
+
+
+class IterJSONObjectsTest(unittest.TestCase):
+    def assertSplits(self, data, expected):
+        for chunk_size in (1, 2, 3, 5, 7, 64, 65536):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(split(data, chunk_size), expected)
+
+    def test_newline_delimited(self):
+        self.assertSplits("\n".join(json.dumps(d) for d in DOCUMENTS).encode() + b"\n", DOCUMENTS)
+        self.assertSplits("\r\n\r\n".join(json.dumps(d, ensure_ascii=False) for d in DOCUMENTS).encode(), DOCUMENTS)
+
+    def test_array(self):
+        self.assertSplits(json.dumps(DOCUMENTS).encode(), DOCUMENTS)
+        self.assertSplits(json.dumps(DOCUMENTS, indent=2).encode(), DOCUMENTS)
+        self.assertSplits(b" [ ] ", [])
+
+    def test_concatenated(self):
+        self.assertSplits("".join(json.dumps(d, separators=(",", ":")) for d in DOCUMENTS).encode(), DOCUMENTS)
+        self.assertSplits(b"".join(json.dumps(d).encode() for d in DOCUMENTS * 3), DOCUMENTS * 3)
+
+    def test_escapes_split_across_chunks(self):
+        # every backslash run length, ending right before or after a quote
+        documents = [{"s": "\\" * n + suffix} for n in range(6) for suffix in ("", "\"", "}", "x")]
+        self.assertSplits("\n".join(json.dumps(d) for d in documents).encode(), documents)
+
+    def test_report(self):
+        reports = [generate_report(biomarkers=2, germline=1, uncertain=3, seed=seed) for seed in range(3)]
+        self.assertSplits(json.dumps(reports).encode(), json.loads(json.dumps(reports)))
+
+    def test_empty_stream(self):
+        self.assertSplits(b"", [])
+        self.assertSplits(b" \n\t", [])
+
+    def test_truncated_stream(self):
+        data = json.dumps(DOCUMENTS[1]).encode()
+        for end in range(1, len(data)):
+            with self.subTest(end=end):
+                with self.assertRaises(JSONStreamError):
+                    split(data[:end], 3)
+        with self.assertRaises(JSONStreamError):
+            split(json.dumps(DOCUMENTS).encode()[:-1], 3)
+
+    def test_not_an_object(self):
+        for data in (b"1", b'"report"', b"null", b"[1]", b"[[{}]]", b'{"a": 1}\n2', b"]"):
+            with self.subTest(data=data):
+                with self.assertRaises(JSONStreamError):
+                    split(data, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from collections import Counter, deque
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mllp import MLLPConnectionPool, Ack, AckError, UnmatchedAckError, match_ack
+from outbox import Outbox, DeliveryWorker
+from mllp_stub_server import MLLPStubServer
+
+# Delivery against the local MLLP stub (mllp_stub_server.py): ACK correlation, NAK-only retries and
+# reconnecting. Runs with python3 -m pytest test/ or python3 test/test_mllp.py.
+
+def make_message(control_id):
+    return f"MSH|^~\\&|RRH||Beaker||20240101||ORU^R01|{control_id}|P|2.3||||||\rPID|1||123^^^MRN^MRN||DOE^JANE^||19700101|F"
+
+def undelivered(outbox):
+    with closing(outbox.connect()) as db:
+        return db.execute("SELECT COUNT(*) FROM messages WHERE status != 'sent'").fetchone()[0]
+
+def make_messages(count, prefix="M"):
+    return [(f"{prefix}{idx}", make_message(f"{prefix}{idx}")) for idx in range(count)]
+
+
+class StubTestCase(unittest.TestCase):
+    stub_settings = {}
+
+    def setUp(self):
+        self.stub = MLLPStubServer(**self.stub_settings).start()
+        self.pool = MLLPConnectionPool(self.stub.host, self.stub.port, size=1, timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.stub.stop()
+
+    def send(self, messages, window=8):
+        with self.pool.connection() as conn:
+            return conn.send_messages(messages, window=window)
+
+
+class AckCorrelationTest(StubTestCase):
+    stub_settings = {"error_rate": 0.3, "reject_rate": 0.1, "latency": 0.001, "jitter": 0.002, "seed": 1}
+
+    def test_acks_are_matched_to_their_messages(self):
+        messages = make_messages(40)
+        results = self.send(messages, window=8)
+        answers = dict(self.stub.answers)
+        self.assertEqual(len(answers), len(messages))
+        for (control_id, _), result in zip(messages, results):
+            if isinstance(result, AckError):
+                self.assertEqual(result.ack.control_id, control_id)
+                self.assertEqual(result.ack.code, answers[control_id])
+            else:
+                self.assertIsInstance(result, Ack)
+                self.assertEqual(result.control_id, control_id)
+                self.assertEqual(answers[control_id], "AA")
+        self.assertIn("AE", answers.values())
+
+    def test_acks_in_any_order(self):
+        messages = make_messages(3)
+        in_flight = deque([0, 1, 2])
+        self.assertEqual(match_ack(Ack("MSA|AA|M2"), messages, in_flight), 2)
+        self.assertEqual(match_ack(Ack("MSA|AA|M0"), messages, in_flight), 0)
+        self.assertEqual(match_ack(Ack("MSA|AA|"), messages, in_flight), 0)
+        self.assertIsNone(match_ack(Ack("MSA|AA|X9"), messages, in_flight))
+
+
+class NakRetryTest(StubTestCase):
+    stub_settings = {"error_rate": 0.3, "seed": 2}
+
+    def test_only_naked_messages_are_retried(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outbox = Outbox(os.path.join(directory, "outbox.sqlite3"))
+            for idx in range(20):
+                outbox.enqueue(f"S{idx}", [("tumor", make_message(f"T{idx}")), ("normal", make_message(f"N{idx}"))])
+
+            def send(rows):
+                with self.pool.connection() as conn:
+                    return conn.send_messages([(row["control_id"], row["message"]) for row in rows], window=8)
+
+            worker = DeliveryWorker(outbox, send, backoff=0.01, max_backoff=0.05, poll_interval=0.05, batch_size=8)
+            worker.start()
+            try:
+                deadline = time.time() + 20
+                while undelivered(outbox):
+                    self.assertLess(time.time(), deadline, "messages weren't all delivered")
+                    time.sleep(0.05)
+            finally:
+                worker.stop()
+                worker.join(5)
+
+        accepted = Counter(control_id for control_id, code in self.stub.answers if code == "AA")
+        received = Counter(control_id for control_id, _ in self.stub.answers)
+        self.assertEqual(len(accepted), 40)
+        self.assertTrue(all(count == 1 for count in accepted.values()), "an accepted message was sent again")
+        self.assertGreater(sum(received.values()), 40)
+        for control_id, count in received.items():
+            naks = sum(1 for answer_id, code in self.stub.answers if answer_id == control_id and code != "AA")
+            self.assertEqual(count, naks + 1)
+
+
+class ReconnectTest(StubTestCase):
+    def test_dropped_idle_connection_is_replaced_on_checkout(self):
+        self.assertIsInstance(self.send(make_messages(2, "A"))[0], Ack)
+        self.stub.close_connections()
+        time.sleep(0.1)
+        results = self.send(make_messages(2, "B"))
+        self.assertTrue(all(isinstance(result, Ack) for result in results))
+        self.assertEqual(self.stub.stats()["connections"], 2)
+
+    def test_dropped_connection_is_reconnected_once_mid_send(self):
+        conn = self.pool.checkout()
+        try:
+            self.assertIsInstance(conn.send_messages(make_messages(1, "A"))[0], Ack)
+            self.stub.close_connections()
+            time.sleep(0.1)
+            # skip the checkout health check, as if the engine dropped the socket just after it
+            results = conn.send_messages(make_messages(3, "B"), window=8)
+        finally:
+            self.pool.checkin(conn)
+        self.assertTrue(all(isinstance(result, Ack) for result in results))
+        self.assertEqual(self.stub.stats()["connections"], 2)
+
+    def test_lost_connection_fails_unacknowledged_messages(self):
+        self.stub.drop_rate = 1.0
+        results = self.send(make_messages(3))
+        self.assertTrue(all(isinstance(result, ConnectionError) for result in results))
+        # only a reused connection is reconnected and resent on
+        self.assertEqual(self.stub.stats()["connections"], 1)
+
+
+class UnmatchedAckTest(StubTestCase):
+    stub_settings = {"rewrite_control_ids": True, "latency": 0.001}
+
+    def test_only_message_in_flight_takes_the_ack(self):
+        results = self.send(make_messages(3), window=1)
+        self.assertTrue(all(isinstance(result, Ack) and result.accepted for result in results))
+        self.assertEqual(self.stub.stats()["received"], 3)
+
+    def test_accepted_messages_in_flight_are_not_resent(self):
+        results = self.send(make_messages(20), window=8)
+        self.assertTrue(all(isinstance(result, Ack) and result.accepted for result in results))
+        self.assertEqual(self.stub.stats()["received"], 20)
+        self.assertTrue(self.pool.unmatched_acks)
+
+    def test_nak_among_unmatched_acks_fails_the_messages_in_flight(self):
+        self.stub.error_rate = 1.0
+        results = self.send(make_messages(10), window=4)
+        self.assertTrue(all(isinstance(result, UnmatchedAckError) for result in results[:4]))
+        self.assertTrue(all(isinstance(result, AckError) for result in results[4:]))
+        self.assertEqual(self.stub.stats()["received"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
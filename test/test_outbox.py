@@ -0,0 +1,205 @@
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from outbox import Outbox
+from synthetic_report import generate_report
+
+# Outbox bookkeeping: per-destination duplicates, superseding and holding back older submissions of a
+# sample, stranded destinations and the retention purge. Runs with python3 -m pytest test/.
+
+def make_message(control_id):
+    return f"MSH|^~\\&|RRH||Beaker||20240101||ORU^R01|{control_id}|P|2.3||||||\rPID|1||123^^^MRN^MRN||DOE^JANE^||19700101|F"
+
+def statuses(outbox, tracking_id):
+    return {(m["destination"], m["kind"]): m["status"] for m in outbox.status(tracking_id)["messages"]}
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(os.path.join(self.directory.name, "outbox.sqlite3"), retention_days=1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def enqueue(self, sample_id, prefix, content_hash, destinations=("prod", "wh"), kinds=("tumor", "normal")):
+        return self.outbox.enqueue(sample_id, [(kind, make_message(f"{prefix}{kind[0]}")) for kind in kinds],
+                                   content_hash, destinations)
+
+    # claims everything due and answers it: sent at the destinations in sent, failed for good elsewhere
+    def deliver(self, sent=("prod", "wh")):
+        rows = self.outbox.claim(100)
+        for row in rows:
+            if row["destination"] in sent:
+                self.outbox.mark_sent(row["id"], "AA")
+            else:
+                self.outbox.mark_error(row["id"], "ConnectionRefusedError")
+        return rows
+
+
+class DuplicateTest(OutboxTestCase):
+    def test_duplicate_at_every_destination(self):
+        tracking_id = self.enqueue("S1", "A", "h1")
+        found = self.outbox.find_submissions("h1", ["prod", "wh"])
+        self.assertEqual(sorted(found), ["prod", "wh"])
+        self.assertTrue(all(row["tracking_id"] == tracking_id for row in found.values()))
+        self.deliver()
+        self.assertEqual(sorted(self.outbox.find_submissions("h1", ["prod", "wh"])), ["prod", "wh"])
+
+    def test_failed_destination_is_missing(self):
+        self.enqueue("S1", "A", "h1")
+        self.deliver(sent=("prod",))
+        self.assertEqual(list(self.outbox.find_submissions("h1", ["prod", "wh"])), ["prod"])
+        # queued again for the missing destination only, after which both have it
+        self.enqueue("S1", "B", "h1", destinations=["wh"])
+        found = self.outbox.find_submissions("h1", ["prod", "wh"])
+        self.assertEqual(sorted(found), ["prod", "wh"])
+        self.assertNotEqual(found["prod"]["tracking_id"], found["wh"]["tracking_id"])
+
+    def test_old_content_after_newer_content(self):
+        self.enqueue("S1", "A", "h1")
+        self.deliver()
+        self.enqueue("S1", "B", "h2")
+        self.assertEqual(self.outbox.find_submissions("h1", ["prod", "wh"]), {})
+        self.assertEqual(sorted(self.outbox.find_submissions("h2", ["prod", "wh"])), ["prod", "wh"])
+        # other samples' submissions don't count
+        self.enqueue("S2", "C", "h3")
+        self.assertEqual(sorted(self.outbox.find_submissions("h2", ["prod", "wh"])), ["prod", "wh"])
+
+    def test_unconfigured_destinations_are_ignored(self):
+        self.enqueue("S1", "A", "h1", destinations=["default"])
+        self.assertEqual(self.outbox.find_submissions("h1", ["prod", "wh"]), {})
+
+    def test_stranded_destination_is_failed(self):
+        stranded = self.enqueue("S1", "A", "h1", destinations=["default"])
+        queued = self.enqueue("S2", "B", "h2")
+        self.assertEqual(self.outbox.fail_unknown_destinations(["prod", "wh"]), 2)
+        self.assertEqual(set(statuses(self.outbox, stranded).values()), {"failed"})
+        self.assertEqual(set(statuses(self.outbox, queued).values()), {"pending"})
+
+
+class SupersedeTest(OutboxTestCase):
+    def test_pending_messages_of_the_same_kind_are_superseded(self):
+        first = self.enqueue("S1", "A", "h1", destinations=["prod"])
+        second = self.enqueue("S1", "B", "h2", destinations=["prod"], kinds=("tumor",))
+        self.assertEqual(statuses(self.outbox, first), {("prod", "tumor"): "superseded", ("prod", "normal"): "pending"})
+        self.assertEqual(statuses(self.outbox, second), {("prod", "tumor"): "pending"})
+        self.assertEqual(self.outbox.find_submissions("h1", ["prod"]), {})
+
+    def test_failed_older_message_is_superseded_instead_of_retried(self):
+        first = self.enqueue("S1", "A", "h1", destinations=["prod"], kinds=("tumor",))
+        rows = self.outbox.claim(10)
+        self.enqueue("S1", "B", "h2", destinations=["prod"], kinds=("tumor",))
+        self.outbox.mark_error(rows[0]["id"], "AE", retry_at=time.time())
+        self.assertEqual(statuses(self.outbox, first), {("prod", "tumor"): "superseded"})
+
+    def test_newer_message_is_held_back_while_older_one_is_sending(self):
+        self.enqueue("S1", "A", "h1", destinations=["prod"])
+        sending = self.outbox.claim(10)
+        self.enqueue("S1", "B", "h2", destinations=["prod"], kinds=("tumor",))
+        self.enqueue("S2", "C", "h3", destinations=["prod"], kinds=("tumor",))
+        self.assertEqual([row["control_id"] for row in self.outbox.claim(10)], ["Ct"])
+        self.assertIsNone(self.outbox.next_attempt("prod"))
+        for row in sending:
+            self.outbox.mark_sent(row["id"], "AA")
+        self.assertEqual([row["control_id"] for row in self.outbox.claim(10)], ["Bt"])
+
+    def test_other_kind_does_not_hold_back(self):
+        self.enqueue("S1", "A", "h1", destinations=["prod"])
+        rows = {row["kind"]: row for row in self.outbox.claim(10)}
+        self.enqueue("S1", "B", "h2", destinations=["prod"], kinds=("tumor",))
+        self.outbox.mark_sent(rows["tumor"]["id"], "AA")
+        # the older normal message keeps being retried, but doesn't hold back the newer tumor message
+        self.outbox.mark_error(rows["normal"]["id"], "AE", retry_at=time.time())
+        self.assertEqual(sorted(row["control_id"] for row in self.outbox.claim(10)), ["An", "Bt"])
+
+    def test_other_destination_does_not_hold_back(self):
+        self.enqueue("S1", "A", "h1", destinations=["wh"], kinds=("tumor",))
+        self.outbox.claim(10, "wh")
+        self.enqueue("S1", "B", "h2", destinations=["prod"], kinds=("tumor",))
+        self.assertEqual([row["control_id"] for row in self.outbox.claim(10, "prod")], ["Bt"])
+
+
+class PurgeTest(OutboxTestCase):
+    def test_purge_keeps_what_duplicate_detection_needs(self):
+        kept = self.enqueue("S1", "A", "h1", destinations=["prod"])
+        deleted = self.enqueue("S2", "B", None, destinations=["prod"])
+        failed = self.enqueue("S3", "C", "h3", destinations=["wh"])
+        self.deliver(sent=("prod",))
+        pending = self.enqueue("S4", "D", "h4", destinations=["wh"])
+        self.assertEqual(self.outbox.purge(now=time.time() + 2 * 86400), 6)
+        self.assertIsNone(self.outbox.status(deleted))
+        self.assertEqual(self.outbox.messages(kept), [("tumor", "At", 2), ("normal", "An", 2)])
+        self.assertEqual(list(self.outbox.find_submissions("h1", ["prod"])), ["prod"])
+        with closing(self.outbox.connect()) as db:
+            self.assertEqual(db.execute("SELECT COUNT(*) FROM messages WHERE tracking_id = ? AND message = ''", (kept,)).fetchone()[0], 2)
+        self.assertEqual(set(statuses(self.outbox, failed).values()), {"failed"})
+        self.assertEqual(len(self.outbox.messages(pending)), 2)
+        with closing(self.outbox.connect()) as db:
+            self.assertEqual(db.execute("SELECT COUNT(*) FROM messages WHERE message = ''").fetchone()[0], 4)
+
+
+@unittest.skipUnless(importlib.util.find_spec("flask"), "the server needs flask")
+class ServiceDuplicateTest(unittest.TestCase):
+    def setUp(self):
+        from varseq_hl7 import HL7Service
+        from config import Config
+        self.directory = tempfile.TemporaryDirectory()
+        destinations = os.path.join(self.directory.name, "destinations.json")
+        with open(destinations, "w") as f:
+            json.dump([{"name": "prod", "host": "127.0.0.1", "port": 1}, {"name": "wh", "host": "127.0.0.1", "port": 2}], f)
+        config = Config(destinations=destinations, outbox=os.path.join(self.directory.name, "outbox.sqlite3"), archive_dir="")
+        self.service = HL7Service(config.validate())
+        # nothing is delivered; the tests answer the outbox themselves
+        self.service.start = lambda: None
+        self.report = generate_report(biomarkers=3, germline=2, uncertain=5, seed=1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def send(self, report, force=False):
+        return self.service.send_hl7_msg(self.service.read_report(json.loads(json.dumps(report))), force)
+
+    def answer(self, sent):
+        for row in self.service.outbox.claim(100):
+            if row["destination"] in sent:
+                self.service.outbox.mark_sent(row["id"], "AA")
+            else:
+                self.service.outbox.mark_error(row["id"], "ConnectionRefusedError")
+
+    def test_duplicate_at_every_destination(self):
+        first = self.send(self.report)
+        second = self.send(self.report)
+        self.assertTrue(second["duplicate"])
+        self.assertEqual(second["tracking_id"], first["tracking_id"])
+        self.assertEqual(second["control_ids"], first["control_ids"])
+        self.assertNotIn("duplicate", self.send(self.report, force=True))
+
+    def test_resent_only_to_destinations_that_lack_it(self):
+        first = self.send(self.report)
+        self.answer(sent=("prod",))
+        second = self.send(self.report)
+        self.assertNotIn("duplicate", second)
+        self.assertEqual(list(self.service.outbox.status(second["tracking_id"])["destinations"]), ["wh"])
+        self.assertEqual(self.service.outbox.status(first["tracking_id"])["destinations"], {"prod": "sent", "wh": "failed"})
+        self.assertTrue(self.send(self.report)["duplicate"])
+
+    def test_old_content_after_newer_content_is_sent(self):
+        self.send(self.report)
+        self.answer(sent=("prod", "wh"))
+        amended = generate_report(biomarkers=3, germline=2, uncertain=6, seed=1)
+        self.assertNotIn("duplicate", self.send(amended))
+        reverted = self.send(self.report)
+        self.assertNotIn("duplicate", reverted)
+        self.assertEqual(sorted(self.service.outbox.status(reverted["tracking_id"])["destinations"]), ["prod", "wh"])
+
+
+if __name__ == "__main__":
+    unittest.main()
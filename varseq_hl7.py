@@ -1,397 +1,380 @@
-import hl7.client
-from flask import Flask, request, jsonify
-from datetime import date
-from textwrap import wrap
-from mappings import LOINCS, SEQ_ONTOLOGY_MAP, LAB_CODES, get_variant_id
-import argparse
-
-parser = argparse.ArgumentParser(description='HL7 Server')
-parser.add_argument('--interface-host', required=True, type=str, help='Hostname of the interface server to send HL7 messages to')
-parser.add_argument('--interface-port', required=True, type=int, help='Port of the interface server to send HL7 messages to')
-parser.add_argument('--flask-port', required=True, type=str, help='Port to launch the local Flask server on')
-args = parser.parse_args()
-INTERFACE_HOST = args.interface_host
-INTERFACE_PORT = args.interface_port
-FLASK_PORT = args.flask_port
-
-class VarSeqInfo():
-    def __init__(self, varseq_json):
-        self.obx_idx = 0
-        self.varseq_json = varseq_json
-        self.sample_state = varseq_json["sampleState"]
-        self.coverage_summary = varseq_json["coverageSummary"]
-        self.panel = self.coverage_summary["panelName"]
-        self.sample_id = self.get_sample_id()
-        self.mrn = self.get_mrn()
-        self.pt_ln, self.pt_fn = self.get_pt_name()
-        self.bday = self.get_date("dob")
-        self.sex = self.get_sex(self.sample_state["sex"])
-        self.prov_ln, self.prov_fn = self.get_prov_name()
-        self.order_num = self.get_custom_field("OrderID")
-        self.date_ordered = self.get_date("dateOrdered")
-        self.date_received = self.get_date("dateReceived")
-        self.prov_id = self.get_prov_id()
-        self.date_sent = self.get_date_sent()
-        self.variants = self.get_all_variants()
-
-    def next_obx_idx(self):
-        self.obx_idx += 1
-        return self.obx_idx
-
-    def reset_obx_idx(self):
-        self.obx_idx = 0
-        return self.obx_idx
-
-    def get_biomarker_variants(self):
-        biomarkers = filter(lambda x: x["type"] == "VARIANT", self.varseq_json["biomarkers"])
-        return list(biomarkers)
-
-    def get_all_variants(self):
-        biomarkers = self.get_biomarker_variants()
-        vus = self.varseq_json["germlineVariants"] + self.varseq_json["uncertainVariants"]
-        if self.panel == "UCLA Pan-Cancer All v1" or self.panel == "Pan-Cancer Solid Tumor Exon Targets":
-            sort_func = lambda x: self.get_vaf(x)
-            reverse = True
-        elif self.panel == "UCLA Heme v2" or self.panel == "GOAL 221 Heme Exon Targets":
-            sort_func = lambda x: x["geneName"]
-            reverse = False
-        if biomarkers:
-            biomarkers.sort(key=sort_func, reverse=reverse)
-        if vus:
-            vus.sort(key=sort_func, reverse=reverse)
-        return biomarkers + vus
-
-    def get_sample_id(self):
-        sample_id = self.sample_state["sampleName"]
-        if sample_id.endswith('R'):
-            return sample_id.rstrip('R')
-        elif sample_id[-1].isdigit() and sample_id[-2] == 'R':
-            return sample_id[:-2]
-        else:
-            return sample_id
-
-    def get_sig(self, sig_name):
-        for biomarker in self.varseq_json["biomarkers"]:
-            if biomarker["type"] == "SIGNATURE" and biomarker["geneName"] == sig_name:
-                return biomarker["quantitativeValue"]
-        return ""
-
-    def get_sex(self, sex):
-        if sex == "Female" or sex == "Male":
-            return sex[0]
-        else:
-            return "O"
-
-    def get_msi(self): 
-        return self.get_sig("MSI")
-
-    def get_tmb(self):
-        return self.get_sig("TMB")
-
-    def get_covg_metrics(self):
-        has_new_covg = self.get_custom_field("ROI_20x") != ""
-        if has_new_covg:
-            bases_20x = self.get_custom_field("ROI_20x")
-            bases_200_or_250x = self.get_custom_field("ROI_250x")
-            bases_500x = self.get_custom_field("ROI_500x")
-            covg_mean = self.get_custom_field("Avg_ROI_Coverage")
-            return [round(float(x), 2) for x in [bases_20x, bases_200_or_250x, bases_500x, covg_mean]]
-        else:
-            covg_summary = self.varseq_json["coverageSummary"]
-            bases_20x = covg_summary["basesAt20x"]
-            bases_200_or_250x = covg_summary["basesAt200x"]
-            bases_500x = covg_summary["basesAt500x"]
-            covg_mean = round(covg_summary["meanDepth"])
-            return [round(float(x), 2) for x in [bases_20x, bases_200_or_250x, bases_500x, covg_mean]]
-
-    def get_custom_field(self, field_name):
-        custom_fields = self.varseq_json["customFields"]
-        if field_name in custom_fields:
-            return custom_fields[field_name]
-        else:
-            return ""
-
-    def get_pt_name(self):
-        # patient names are in the format "Last, First (MRN)"
-        name = self.varseq_json["sampleState"]["patientName"].split(" (")[0]
-        fn, ln = name.split(",")[:2]
-        return fn, ln
-
-    def get_mrn(self):
-        return str(self.sample_state["mrn"]).zfill(7)
-
-    def get_prov_name(self):
-        name = self.varseq_json["sampleState"]["orderingPhysician"]
-        fn, ln = name.split(",")[:2]
-        return fn.strip(), ln.strip()
-
-    def get_prov_id(self):
-        id =  str(self.get_custom_field("ProviderID"))
-        return id.zfill(6)
-
-    def format_header_date(self, date):
-        split_date = date.split("/")
-        if len(split_date) == 3:
-            m, d, y = split_date
-            if len(m) == 1: m = "0" + m
-            if len(d) == 1: d = "0" + d
-            return y + m + d
-        else:
-            raise Exception(f"Invalid date format: {date} found in JSON for {self.sample_id}, patient name: {self.pt_fn} {self.pt_ln}")
-
-    def get_date(self, date_type):
-        # date = self.get_custom_field(date_type).split(" ")[0]
-        if date_type.startswith("N_") or date_type.startswith("Date"):
-            date = self.get_custom_field(date_type).split(" ")[0]
-        else:
-            date = self.varseq_json["sampleState"][date_type]
-        return self.format_header_date(date)
-
-    def get_date_sent(self):
-        return date.today().strftime("%Y%m%d")
-
-    def get_tumor_type(self):
-        tt = self.varseq_json["tumorType"]
-        tt_abbrev = self.varseq_json["tumorTypeAbbrev"]
-        return f"{tt} ({tt_abbrev})"
-
-    def get_clin_sig(self, variant):
-        if variant in self.varseq_json["biomarkers"]:
-            return "Tier 1: Strong significance"
-        else:
-            return "Tier 2: Potential significance"
-
-    def get_variant_type(self, variant):
-        tags = variant["tags"]
-        if tags and len(tags) == 1:
-            type_initials = tags[0]["initials"]
-            if type_initials == "SM":
-                return "Somatic"
-            elif type_initials == "GL":
-                return "Germline"
-        return "Unknown"
-    
-    def insert_newlines(self, s, every=110):
-        return '\.br\\'.join(wrap(s, every)).strip()
-
-    def format_interp(self, interp):
-        interp = interp.replace("<p>", "").replace("</p>", "").replace("<em>", "").replace("</em>", "").replace("&nbsp;", " ").replace("–", "-")
-        return self.insert_newlines(interp)
-
-    def get_interp(self, variant):
-        summary = variant["biomarkerSummary"]
-        if summary:
-            return self.format_interp(summary["interpretation"])
-        else:
-            return ""
-
-    def get_chrom(self, variant):
-        mutation = variant["mutation"]
-        return mutation["chr"] if mutation else ""
-
-    def get_naf(self, variant):
-        naf = variant["naf"]
-        return round(naf, 2) if naf else 0
-
-    def get_consequence(self, variant):
-        consequence = SEQ_ONTOLOGY_MAP.get(variant["sequenceOntology"])
-        if consequence:
-            return consequence
-        else:
-            raise RuntimeError(f"SequenceOntology term {variant['sequenceOntology']} not found")
-
-    def get_dna_change(self, variant):
-        # count number of bases in ref and alt (excluding dashes) to determine if substitution or indel
-        ref, alt = map(lambda b: b.replace('-', ''), variant["refAlt"].split("/"))
-        return "Substitution" if len(alt) == len(ref) else "Insertion/Deletion"
-
-    def get_coords(self, variant):
-        # VarSeq usually uses 0 based coordinates for the starting position,
-        # so we increment "start" to get 1-based coordinates
-        # This is not true for insertions, so in that case we increment "stop" for congruency
-        start, stop = int(variant['start']), int(variant['stop'])
-        if start != stop:
-            start += 1
-        else: # insertion
-            stop += 1
-        return str(start), str(stop)
-
-    def get_loinc_info(self, code):
-        loinc_info = LOINCS.get(code)
-        if loinc_info:
-            loinc_name, loinc_type = loinc_info
-            return f"{loinc_type}|{code}^{loinc_name}^LOINC"
-        else:
-            raise RuntimeError("Invalid LOINC code: " + code)
-
-    def create_obx_segment(self, variant_id, loinc_code, value):
-        return f"""OBX|{self.next_obx_idx()}|{self.get_loinc_info(loinc_code)}|{variant_id}|{value}"""
-
-    def get_variant_obx_function(self, variant_idx):
-        variant_id = get_variant_id(variant_idx)
-        def wrapper_func(loinc_code, value):
-            return self.create_obx_segment(variant_id, loinc_code, value)
-        return wrapper_func
-
-    def get_pdot(self, variant):
-        return variant["pDot"] if variant["pDot"] else "p.?"
-
-    def get_vaf(self, variant):
-        if variant.get("vaf"):
-            return round(variant["vaf"], 2)
-        elif variant.get("sv_vaf"):
-            return round(variant["sv_vaf"], 2)
-		# If no VAF is given, calculate it from altReadCount and readDepth
-        elif variant["altReadCount"] and variant["readDepth"]:
-            return round(variant["altReadCount"] / variant["readDepth"], 2)
-        else:
-            raise RuntimeError(f"VAF not found for variant {variant['geneName']} {variant['cDot']}")
-
-    def get_variant_display_name(self, variant):
-        pdot = self.get_pdot(variant)
-        pdot = "" if pdot == "p.?" else f"{pdot} - "
-        molecular_cons = self.get_consequence(variant)
-        if molecular_cons == "Nonsense":
-            molecular_cons = "Nonsense Variant"
-        return f"{variant['geneName']} {pdot}{variant['cDot']} {molecular_cons}"
-
-    def get_tumor_variant_obxs(self, variant, variant_idx):
-        ref, alt = variant["refAlt"].split("/")
-        start, stop = self.get_coords(variant)
-        create_obx_segment = self.get_variant_obx_function(variant_idx)
-        sv_vaf = variant.get("sv_vaf")
-        if sv_vaf:
-            variant_type = "Structural"
-            allele_depth = variant["sv_reads"]
-        else:
-            variant_type = "Simple"
-            allele_depth = variant["altReadCount"]
-        obxs =  [
-            create_obx_segment("48018-6", '^' + variant["geneName"] + '^'), # Variant Name (This is also a discrete field in EPIC)
-            create_obx_segment("47998-0", self.get_variant_display_name(variant)), # Variant Display Name
-            create_obx_segment("81252-9", 'v1^' + variant['hgvsWithGene'] + '^ClinVar-V'), # Discrete Genetic Variant
-            create_obx_segment("48002-0", '^' + self.get_variant_type(variant)), # Genomic Source Class
-            create_obx_segment("83005-9", variant_type), # EPIC Variant Category (Simple, Complex, Fusion, etc.))
-            create_obx_segment("53037-8", '^' + self.get_clin_sig(variant)), # Genetic Sequence Variation Clinical Significance
-            create_obx_segment("81258-6", self.get_vaf(variant)), # Allelic Frequency
-            create_obx_segment("82121-5", allele_depth), # Allelic Read Depth
-            create_obx_segment("48005-3", self.get_pdot(variant)), # Amino Acid Change p.HGVS
-            create_obx_segment("48019-4", '^' + self.get_dna_change(variant)),
-            create_obx_segment("48004-6", '^' + variant['cDot']), # DNA Change c.HGVS
-            create_obx_segment("81290-9", variant["gDot"]), # Genomic DNA Change g.HGVS
-            create_obx_segment("7400052", variant["proteinId"]),
-            create_obx_segment("51958-7", f"{variant['transcriptName']}^{variant['transcriptName']}^RefSeq-T"), # Transcript Reference Sequence
-            create_obx_segment("48000-4", self.get_chrom(variant)), # Chromosome
-            create_obx_segment("48006-1", '^' + self.get_consequence(variant)),
-            create_obx_segment("69547-8", ref), # Genomic Reference Allele
-            create_obx_segment("69551-0", alt), # Genomic Alternate Allele
-            create_obx_segment("81254-5", f"{start}^{stop}"), # Genomic Allele Start-End
-            create_obx_segment("47999-8", variant["exon"]), # DNA Region
-            create_obx_segment("62374-4", '^' + variant['assembly']), # Human Reference Sequence Assembly Version
-            create_obx_segment("69548-6", "Detected"), # Genetic Variant Assessment
-        ]
-        interp = self.get_interp(variant)
-        if interp: obxs.append(create_obx_segment("93364-8", interp))
-        zyg = variant.get("zygosity")
-        if zyg: obxs.append(create_obx_segment("53034-5", '^' + zyg))
-        sv_len = variant.get("sv_len")
-        if sv_len: obxs.append(create_obx_segment("81300-6", sv_len))
-        return "\r\n".join(obxs)
-
-    # While we send these variants in the tumor's HL7 message, we send them again here for the normal sample so we can get the normal allele frequency
-    def get_normal_variant_obxs(self, variant, variant_idx):
-        create_obx_segment = self.get_variant_obx_function(variant_idx)
-        obxs =  [
-            create_obx_segment("48018-6", '^' + variant["geneName"] + '^'), # Variant Name (This is also a discrete field in EPIC)
-            create_obx_segment("47998-0", self.get_variant_display_name(variant)), # Variant Display Name
-            create_obx_segment("81252-9", f"v1^{variant['hgvsWithGene']}^ClinVar-V"), # Discrete Genetic Variant
-            create_obx_segment("48002-0", f"^{self.get_variant_type(variant)}"), # Genomic Source Class
-            create_obx_segment("53037-8", '^' + self.get_clin_sig(variant)), # Genetic Sequence Variation Clinical Significance
-            create_obx_segment("81258-6", self.get_naf(variant)), # Allelic Frequency
-            create_obx_segment("48005-3", self.get_pdot(variant)), # Amino Acid Change p.HGVS
-            create_obx_segment("48004-6", f"^{variant['cDot']}"), # DNA Change c.HGVS
-            create_obx_segment("48000-4", self.get_chrom(variant)), # Chromosome
-            create_obx_segment("48006-1", '^' + self.get_consequence(variant)),
-            create_obx_segment("62374-4", '^' + variant['assembly']), # Human Reference Sequence Assembly Version
-            create_obx_segment("83005-9", "Simple"), # EPIC Variant Category (Simple, Complex, Fusion, etc.))
-            create_obx_segment("69548-6", "Detected"), # Genetic Variant Assessment
-        ]
-        zyg = variant.get("zygosity")
-        if zyg: obxs.append(create_obx_segment("53034-5", '^' + zyg))
-        return "\r\n".join(obxs)
-
-    def get_tumor_msg_header(self):
-        self.reset_obx_idx()
-        bases_20x, bases_200x, bases_500x, covg_mean = self.get_covg_metrics()
-        lab_code_segment = LAB_CODES.get(self.panel)
-        header = f"""MSH|^~\&|RRH||Beaker||{self.date_sent}||ORU^R01|1|P|2.3||||||\r
-PID|1||{self.mrn}^^^MRN^MRN||{self.pt_ln}^{self.pt_fn}^||{self.bday}|{self.sex}\r
-ORC|RE\r
-OBR|1|{self.order_num}|{self.sample_id}^Beaker|{lab_code_segment}|||{self.date_ordered}|||||||||{self.prov_id}^{self.prov_ln}^{self.prov_fn}^^^^^^EPIC^^^^PROVID||||||{self.date_received}|||F\r
-{self.create_obx_segment("2a", "7102415", f"^{self.get_tumor_type()}")}\r
-{self.create_obx_segment("2a", "7102423", bases_20x)}\r
-{self.create_obx_segment("2a", "7102424", bases_200x)}\r
-{self.create_obx_segment("2a", "7102425", bases_500x)}\r
-{self.create_obx_segment("2a", "7102426", covg_mean)}\r"""
-        if self.panel == "UCLA Pan-Cancer All v1" or self.panel == "Pan-Cancer Solid Tumor Exon Targets":
-            header += f"""{self.create_obx_segment("2a", "81695-9", f"^{self.get_msi()}")}\r"""
-            header += f"""{self.create_obx_segment("2a", "94076-7", f"{self.get_tmb()}")}\r"""
-        return header
-
-    def get_normal_msg_header(self):
-        self.reset_obx_idx()
-        norm_sample_id = self.get_custom_field("N_SID").rstrip('R')
-        norm_order_num = self.get_custom_field("N_OrderID")
-        norm_date_ordered = self.get_date("N_DateOrdered")
-        norm_date_received = self.get_date("N_DateReceived")
-        return f"""MSH|^~\&|RRH||Beaker||{self.date_sent}||ORU^R01|1|P|2.3||||||\r
-PID|1||{self.mrn}^^^MRN^MRN||{self.pt_ln}^{self.pt_fn}^||{self.bday}|{self.sex}\r
-ORC|RE\r
-OBR|1|{norm_order_num}|{norm_sample_id}^Beaker|LAB9056^Pan-cancer Panel, Comparator^BKREAP^^^^^^SOLID TUMOR PAN-CANCER PANEL|||{norm_date_ordered}|||||||||{self.prov_id}^{self.prov_ln}^{self.prov_fn}^^^^^^EPIC^^^^PROVID||||||{norm_date_received}|||F\r"""
-
-    def get_tumor_obxs(self):
-        return "\r\n".join([self.get_tumor_variant_obxs(variant, idx) for idx, variant in enumerate(self.variants)])
-
-    def get_normal_obxs(self):
-        germline_variants = filter(lambda x: self.get_variant_type(x) == "Germline", self.variants)
-        return "\r\n".join([self.get_normal_variant_obxs(variant, idx) for idx, variant in enumerate(germline_variants)])
-
-    def get_tumor_msg(self):
-        return self.get_tumor_msg_header() + self.get_tumor_obxs()
-
-    def get_normal_msg(self):
-        if self.panel == "UCLA Pan-Cancer All v1" or self.panel == "Pan-Cancer Solid Tumor Exon Targets":
-            header = self.get_normal_msg_header()
-            normal_obxs = self.get_normal_obxs()
-            if normal_obxs:
-                return header + normal_obxs
-        return ""
-
-def send_hl7_msg(vs_json):
-    vs_info = VarSeqInfo(vs_json)
-    tumor_msg, normal_msg = vs_info.get_tumor_msg(), vs_info.get_normal_msg()
-    with hl7.client.MLLPClient(INTERFACE_HOST, INTERFACE_PORT) as client:
-        with open(f"{vs_info.sample_id}_tumor_msg.txt", "w") as f:
-            f.write(tumor_msg)
-        print(client.send_message(tumor_msg))
-        print(f"Sent tumor message: {tumor_msg.splitlines()[3]}")
+from flask import Flask, Blueprint, Response, current_app, request, jsonify, url_for, stream_with_context
+from config import Config
+from varseq_info import VarSeqInfo
+from mllp import MLLPConnectionPool, Ack, AckError
+from control_ids import get_control_id
+from outbox import Outbox, DeliveryWorker, count_segments
+from archive import Archive, ArchiveWriter
+from destinations import load_destinations
+from logs import setup_logging
+from profiling import RequestProfiler, get_sample_name
+from idempotency import LRUCache, content_hash
+from json_stream import iter_json_objects, JSONStreamError
+from metrics import REGISTRY, CONTENT_TYPE, STAGE_SECONDS, REPORTS, REPORT_VARIANTS, MESSAGE_BYTES, DELIVERIES, get_panel
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+log = logging.getLogger("varseq2hl7.server")
+
+# Everything one server process needs: the outbox, a delivery worker and connection pool per destination
+# (see destinations.py), and the message archive. The pools and the worker and archive threads are created
+# on first use in each process (see start), so an app created before a WSGI server forks
+# (gunicorn --preload) doesn't share sockets, files or threads between its workers.
+class HL7Service():
+    def __init__(self, config):
+        self.config = config
+        self.outbox = Outbox(config.outbox, retention_days=config.outbox_retention_days)
+        self.destinations = load_destinations(config)
+        stranded = self.outbox.fail_unknown_destinations([destination.name for destination in self.destinations])
+        if stranded:
+            log.warning("Failed messages queued for destinations that are no longer configured", extra={"messages": stranded})
+        self.recent = LRUCache(config.dedup_cache_size)
+        # rendered OBXs of recently seen variants, so amended reports only render what changed
+        self.render_cache = LRUCache(config.render_cache_size) if config.render_cache_size > 0 else None
+        self.archive = None
+        if config.archive_dir:
+            self.archive = Archive(config.archive_dir, compress=config.archive_compress,
+                                   segment_size=int(config.archive_segment_mb * 1024 * 1024),
+                                   retention_days=config.archive_retention_days)
+        self.profiler = None
+        if config.profile_dir:
+            self.profiler = RequestProfiler(config.profile_dir, sample_rate=config.profile_sample_rate,
+                                            keep=config.profile_keep, collapsed=config.profile_collapsed)
+        self.pools = {}
+        self.workers = {}
+        self.archiver = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # a pool per destination, so each is delivered to independently, and a worker thread per pooled
+            # connection, claiming from the same outbox
+            for destination in self.destinations:
+                self.pools[destination.name] = MLLPConnectionPool(
+                    destination.host, destination.port, size=destination.pool_size, timeout=destination.interface_timeout,
+                    idle_timeout=destination.idle_timeout, name=destination.name)
+                self.workers[destination.name] = [
+                    DeliveryWorker(self.outbox, functools.partial(self.deliver_hl7_msgs, destination), max_attempts=destination.max_attempts,
+                                   backoff=destination.retry_backoff, batch_size=destination.send_window, destination=destination.name,
+                                   name=f"outbox-delivery-{destination.name}-{idx}")
+                    for idx in range(max(1, destination.pool_size))
+                ]
+                for worker in self.workers[destination.name]:
+                    worker.start()
+            if self.archive:
+                self.archiver = ArchiveWriter(self.archive)
+                self.archiver.start()
+            self.pid = os.getpid()
+            # the archive writer's queued messages would be lost with its daemon thread
+            atexit.register(self.stop)
+
+    # stops this process's threads, writing out the archive queue; called on exit (and by gunicorn's worker_exit)
+    def stop(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.pid = None
+        for workers in self.workers.values():
+            for worker in workers:
+                worker.stop()
+        if self.archiver:
+            self.archiver.stop()
+        for pool in self.pools.values():
+            pool.close()
+
+    # projects a parsed report into the records its messages are built from; the caller can let go of
+    # the JSON once this returns
+    def read_report(self, vs_json):
+        with STAGE_SECONDS.time(stage="construct", panel=get_panel(vs_json)):
+            return VarSeqInfo(vs_json, render_cache=self.render_cache)
+
+    # force skips the duplicate check, so an unchanged report is rendered and sent again (to every destination)
+    def send_hl7_msg(self, vs_info, force=False):
+        panel = vs_info.panel
+        digest = None
+        destinations = [destination.name for destination in self.destinations]
+        if self.config.dedup:
+            with STAGE_SECONDS.time(stage="content_hash", panel=panel):
+                digest = content_hash(vs_info)
+            if not force:
+                submissions = self.outbox.find_submissions(digest, destinations)
+                if len(submissions) == len(destinations):
+                    duplicate = self.find_duplicate(digest, submissions)
+                    log.info("Duplicate report, not sent again", extra={"sample_id": duplicate["sample_id"],
+                                                                        "tracking_id": duplicate["tracking_id"], "panel": panel})
+                    return duplicate
+                if submissions:
+                    # only the destinations that don't have it yet get it
+                    log.info("Report already delivered to some destinations", extra={
+                        "sample_id": vs_info.sample_id, "panel": panel, "destinations": ",".join(sorted(submissions))})
+                    destinations = [name for name in destinations if name not in submissions]
+        with STAGE_SECONDS.time(stage="render_tumor", panel=panel):
+            tumor_msg = vs_info.get_tumor_msg()
+        with STAGE_SECONDS.time(stage="render_normal", panel=panel):
+            normal_msg = vs_info.get_normal_msg()
+        messages = [("tumor", tumor_msg)]
         if normal_msg:
-            with open(f"{vs_info.sample_id}_normal_msg.txt", "w") as f:
-                f.write(normal_msg)
-            print(client.send_message(normal_msg))
-            print(f"Sent normal message: {normal_msg.splitlines()[3]}")
-    return vs_json
-
-app = Flask(__name__)
-@app.route('/receivejson', methods=['POST'])
+            messages.append(("normal", normal_msg))
+        with STAGE_SECONDS.time(stage="enqueue", panel=panel):
+            tracking_id = self.outbox.enqueue(vs_info.sample_id, messages, digest, destinations)
+        self.start()
+        for workers in self.workers.values():
+            for worker in workers:
+                worker.wake()
+        if self.archiver:
+            # only hands the messages to the archive thread
+            with STAGE_SECONDS.time(stage="archive", panel=panel):
+                self.archiver.submit(vs_info.sample_id, tracking_id, [(kind, get_control_id(msg), msg) for kind, msg in messages])
+        REPORT_VARIANTS.labels(panel=panel).observe(len(vs_info.variants))
+        for kind, msg in messages:
+            MESSAGE_BYTES.labels(panel=panel, kind=kind).observe(len(msg.encode("utf-8")))
+        log.info("Queued messages", extra={"sample_id": vs_info.sample_id, "tracking_id": tracking_id, "panel": panel,
+                                           "messages": len(messages), "variants": len(vs_info.variants),
+                                           "cached_variants": vs_info.cached_variants})
+        result = {
+            "tracking_id": tracking_id,
+            "sample_id": vs_info.sample_id,
+            "segments": {kind: count_segments(msg) for kind, msg in messages},
+            "control_ids": {kind: get_control_id(msg) for kind, msg in messages},
+        }
+        if digest:
+            self.recent.put(digest, result)
+        return dict(result)
+
+    # the response to the latest earlier submission of the same content, given the submissions that were
+    # delivered or are still queued at every destination (see Outbox.find_submissions)
+    def find_duplicate(self, digest, submissions):
+        submission = max(submissions.values(), key=lambda row: row["last_id"])
+        result = self.recent.get(digest)
+        if result is None or result["tracking_id"] != submission["tracking_id"]:
+            # submitted by another worker process, or before a restart
+            messages = self.outbox.messages(submission["tracking_id"])
+            result = {
+                "tracking_id": submission["tracking_id"],
+                "sample_id": submission["sample_id"],
+                "segments": {kind: segments for kind, _, segments in messages},
+                "control_ids": {kind: control_id for kind, control_id, _ in messages},
+            }
+            self.recent.put(digest, result)
+        return dict(result, duplicate=True)
+
+    # called by a destination's delivery worker with its due messages in the outbox, which are pipelined
+    # over one connection; a NAK or connection error for a message schedules a retry of just that message
+    def deliver_hl7_msgs(self, destination, rows):
+        messages = [(row["control_id"] or get_control_id(row["message"]), row["message"]) for row in rows]
+        with self.pools[destination.name].connection() as client:
+            results = client.send_messages(messages, window=destination.send_window)
+        for row, (control_id, message), result in zip(rows, messages, results):
+            if isinstance(result, Ack):
+                DELIVERIES.labels(kind=row["kind"], destination=destination.name, result="sent").inc()
+                log.info("Sent message", extra={"sample_id": row["sample_id"], "kind": row["kind"], "destination": destination.name,
+                                                "control_id": control_id, "ack": result.code, "attempt": row["attempts"] + 1})
+                log.debug("ACK", extra={"control_id": control_id, "raw": result.raw})
+            else:
+                DELIVERIES.labels(kind=row["kind"], destination=destination.name,
+                                  result="nak" if isinstance(result, AckError) else "error").inc()
+        return results
+
+def get_service():
+    return current_app.extensions["varseq2hl7"]
+
+routes = Blueprint("varseq2hl7", __name__)
+
+def flag(name):
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
+
+# Converts and queues one report, under the profiler if it was asked for, and counts the outcome.
+# reports is a list holding the parsed report, which is taken out of it once projected, so the JSON
+# is released before rendering unless the caller still holds it
+def convert_report(service, reports, panel, force):
+    try:
+        if service.profiler is not None and service.profiler.requested(request):
+            result = service.profiler.run(lambda reports: service.send_hl7_msg(service.read_report(reports.pop()), force),
+                                          reports, get_sample_name(reports[-1]))
+        else:
+            result = service.send_hl7_msg(service.read_report(reports.pop()), force)
+    except Exception:
+        REPORTS.labels(panel=panel, outcome="error").inc()
+        log.exception("Failed to convert report", extra={"panel": panel})
+        raise
+    REPORTS.labels(panel=panel, outcome="duplicate" if result.get("duplicate") else "queued").inc()
+    return result
+
+@routes.route('/receivejson', methods=['POST'])
 def receive_json():
-    data = request.get_json()
+    # the parsed report isn't cached on the request, and is only sent back when asked for with ?echo=1
+    start = time.perf_counter()
+    data = request.get_json(cache=False)
+    panel = get_panel(data)
+    STAGE_SECONDS.labels(stage="parse_json", panel=panel).observe(time.perf_counter() - start)
     if data:
-        result = send_hl7_msg(data)
-        return jsonify(result), 200
+        echo = data if flag("echo") else None
+        reports = [data]
+        del data
+        result = convert_report(get_service(), reports, panel, flag("force"))
+        result["status_url"] = url_for("varseq2hl7.message_status", tracking_id=result["tracking_id"])
+        if echo is not None:
+            result["report"] = echo
+        STAGE_SECONDS.labels(stage="total", panel=panel).observe(time.perf_counter() - start)
+        # nothing new was queued for a duplicate
+        return jsonify(result), 200 if result.get("duplicate") else 202
     else:
+        REPORTS.labels(panel=panel, outcome="invalid").inc()
         return jsonify({"error": "No JSON data received"}), 400
 
-# launches Flask server on localhost:FLASK_PORT
+# Accepts many reports in one request: newline-delimited JSON, a JSON array, or concatenated JSON objects.
+# Reports are read from the request stream, converted and queued one at a time, and a result line is
+# streamed back (as NDJSON) as soon as each one is done, followed by a line with the totals
+@routes.route('/receivejson/batch', methods=['POST'])
+def receive_json_batch():
+    service = get_service()
+    force = flag("force")
+    stream = request.stream
+
+    def results():
+        totals = {"queued": 0, "duplicate": 0, "error": 0}
+        index = 0
+        documents = iter_json_objects(stream)
+        while True:
+            start = time.perf_counter()
+            line = {"index": index, "sample_id": None, "status": "error", "tracking_id": None, "control_ids": None, "error": None}
+            broken = False
+            try:
+                document = next(documents, None)
+                if document is None:
+                    break
+                data = json.loads(document)
+                del document
+            except JSONStreamError as e:
+                # the stream itself is broken, so there's no next report to go on to
+                line["error"] = f"{type(e).__name__}: {e}"
+                broken = True
+            except ValueError as e:
+                REPORTS.labels(panel="", outcome="invalid").inc()
+                line["error"] = f"{type(e).__name__}: {e}"
+            else:
+                panel = get_panel(data)
+                sample_name = get_sample_name(data)
+                STAGE_SECONDS.labels(stage="parse_json", panel=panel).observe(time.perf_counter() - start)
+                reports = [data]
+                del data
+                try:
+                    result = convert_report(service, reports, panel, force)
+                except Exception as e:
+                    line["sample_id"] = sample_name
+                    line["error"] = f"{type(e).__name__}: {e}"
+                else:
+                    line.update(sample_id=result["sample_id"], tracking_id=result["tracking_id"], control_ids=result["control_ids"],
+                                status="duplicate" if result.get("duplicate") else "queued")
+                    STAGE_SECONDS.labels(stage="total", panel=panel).observe(time.perf_counter() - start)
+            totals[line["status"]] += 1
+            yield json.dumps(line) + "\n"
+            index += 1
+            if broken:
+                break
+        yield json.dumps({"done": True, "reports": index, **totals}) + "\n"
+
+    return Response(stream_with_context(results()), status=200, mimetype="application/x-ndjson")
+
+# Searches the archive by ?sample_id=, ?control_id= and/or ?tracking_id= (newest first, up to ?limit=);
+# ?messages=1 includes the messages themselves
+@routes.route('/archive', methods=['GET'])
+def search_archive():
+    archive = get_service().archive
+    if archive is None:
+        return jsonify({"error": "Archiving is disabled (--archive-dir)"}), 404
+    search = {name: request.args.get(name) for name in ("sample_id", "control_id", "tracking_id")}
+    if not any(search.values()):
+        return jsonify({"error": "Expected a sample_id, control_id or tracking_id"}), 400
+    entries = archive.find(**search, limit=request.args.get("limit", 100, type=int))
+    if flag("messages"):
+        for entry in entries:
+            entry["message"] = archive.read(entry)
+    return jsonify({"archived": entries})
+
+@routes.route('/status/<tracking_id>', methods=['GET'])
+def message_status(tracking_id):
+    status = get_service().outbox.status(tracking_id)
+    if status:
+        return jsonify(status), 200
+    else:
+        return jsonify({"error": f"Unknown tracking ID {tracking_id}"}), 404
+
+@routes.route('/metrics', methods=['GET'])
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+# Builds the app from config, or from VARSEQ2HL7_* environment variables when none is given (the way a
+# WSGI server calls it). Nothing is sent until a worker process starts the service (see gunicorn.conf.py)
+# or gets its first report.
+def create_app(config=None):
+    config = (config or Config.from_env()).validate()
+    setup_logging(config.log_level, config.log_format)
+    app = Flask(__name__)
+    app.config["VARSEQ2HL7"] = config
+    app.extensions["varseq2hl7"] = HL7Service(config)
+    app.register_blueprint(routes)
+    return app
+
+# starts the service in each gunicorn worker process once it has loaded the app
+def post_worker_init(worker):
+    worker.wsgi.extensions["varseq2hl7"].start()
+
+# and stops it when the worker exits
+def worker_exit(server, worker):
+    worker.wsgi.extensions["varseq2hl7"].stop()
+
+# Pre-forked gunicorn workers, each with its own request threads, delivery worker and connection pool.
+# The app (and with it the LOINC/variant ID mappings) is loaded once before forking
+def serve_gunicorn(app, config):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{config.bind}:{config.flask_port}")
+            self.cfg.set("workers", config.workers)
+            self.cfg.set("threads", config.threads)
+            self.cfg.set("preload_app", True)
+            self.cfg.set("post_worker_init", post_worker_init)
+            self.cfg.set("worker_exit", worker_exit)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+def serve(app, config):
+    service = app.extensions["varseq2hl7"]
+    if config.serve == "dev":
+        # with debug=True this also runs in the reloader's watcher process, which shouldn't deliver anything
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            service.start()
+        app.run(host=config.bind, port=config.flask_port, debug=True)
+        return
+    try:
+        import gunicorn
+    except ImportError:
+        log.warning("gunicorn is not installed, serving with threads in a single process")
+        service.start()
+        app.run(host=config.bind, port=config.flask_port, threaded=True)
+        return
+    serve_gunicorn(app, config)
+
+# launches Flask server on BIND:FLASK_PORT
 if __name__ == '__main__':
-    app.run(port=FLASK_PORT, debug=True)
+    try:
+        config = Config.from_args().validate()
+    except ValueError as e:
+        sys.exit(f"varseq_hl7.py: error: {e}")
+    serve(create_app(config), config)
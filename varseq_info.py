@@ -0,0 +1,441 @@
+from datetime import date
+from io import StringIO
+from mappings import LOINC_PREFIXES, SEQ_ONTOLOGY_MAP, LAB_CODES, get_variant_id
+from records import HeaderRecord, VariantRecord
+from hl7_text import format_interp
+from control_ids import CONTROL_IDS
+
+class VarSeqInfo():
+    # varseq_json is only read here; everything rendered later comes from the compact records built from it.
+    # Every rendered message gets its MSH-10 from next_control_id (by default unique per message).
+    # render_cache (e.g. an idempotency.LRUCache shared between reports) keeps the rendered OBXs of each
+    # variant, so an amended report only renders the variants that changed (see write_cached_variant_obxs)
+    def __init__(self, varseq_json, next_control_id=None, render_cache=None):
+        self.next_control_id = next_control_id or CONTROL_IDS.next_id
+        self.render_cache = render_cache
+        self.cached_variants = 0
+        self.obx_idx = 0
+        self.header = HeaderRecord.from_json(varseq_json)
+        self.sample_state = self.header["sampleState"]
+        self.coverage_summary = self.header["coverageSummary"]
+        self.panel = self.coverage_summary["panelName"]
+        self.sample_id = self.get_sample_id()
+        self.mrn = self.get_mrn()
+        self.pt_ln, self.pt_fn = self.get_pt_name()
+        self.bday = self.get_date("dob")
+        self.sex = self.get_sex(self.sample_state["sex"])
+        self.prov_ln, self.prov_fn = self.get_prov_name()
+        self.order_num = self.get_custom_field("OrderID")
+        self.date_ordered = self.get_date("dateOrdered")
+        self.date_received = self.get_date("dateReceived")
+        self.prov_id = self.get_prov_id()
+        self.date_sent = self.get_date_sent()
+        self.variants = self.get_all_variants(varseq_json)
+        self.variant_fields = [self.get_variant_fields(variant) for variant in self.variants]
+        self.germline_variants = [
+            (variant, fields) for variant, fields in zip(self.variants, self.variant_fields)
+            if fields["variant_type"] == "Germline"
+        ]
+
+    def next_obx_idx(self):
+        self.obx_idx += 1
+        return self.obx_idx
+
+    def reset_obx_idx(self):
+        self.obx_idx = 0
+        return self.obx_idx
+
+    def get_biomarker_variants(self, varseq_json):
+        biomarkers = filter(lambda x: x["type"] == "VARIANT", varseq_json["biomarkers"])
+        return list(biomarkers)
+
+    # sorts the report's variants and projects them into VariantRecords; clinical significance is decided
+    # here, against the full biomarker JSON, since it compares whole variants
+    def get_all_variants(self, varseq_json):
+        biomarkers = self.get_biomarker_variants(varseq_json)
+        vus = varseq_json["germlineVariants"] + varseq_json["uncertainVariants"]
+        if self.panel == "UCLA Pan-Cancer All v1" or self.panel == "Pan-Cancer Solid Tumor Exon Targets":
+            sort_func = lambda x: self.get_vaf(x)
+            reverse = True
+        elif self.panel == "UCLA Heme v2" or self.panel == "GOAL 221 Heme Exon Targets":
+            sort_func = lambda x: x["geneName"]
+            reverse = False
+        if biomarkers:
+            biomarkers.sort(key=sort_func, reverse=reverse)
+        if vus:
+            vus.sort(key=sort_func, reverse=reverse)
+        tier1_ids, tier1_by_key = self.get_tier1_index(varseq_json["biomarkers"])
+        return [
+            VariantRecord.from_json(variant, self.get_clin_sig(variant, tier1_ids, tier1_by_key))
+            for variant in biomarkers + vus
+        ]
+
+    def get_sample_id(self):
+        sample_id = self.sample_state["sampleName"]
+        if sample_id.endswith('R'):
+            return sample_id.rstrip('R')
+        elif sample_id[-1].isdigit() and sample_id[-2] == 'R':
+            return sample_id[:-2]
+        else:
+            return sample_id
+
+    def get_sig(self, sig_name):
+        for biomarker in self.header["biomarkers"]:
+            if biomarker["type"] == "SIGNATURE" and biomarker["geneName"] == sig_name:
+                return biomarker["quantitativeValue"]
+        return ""
+
+    def get_sex(self, sex):
+        if sex == "Female" or sex == "Male":
+            return sex[0]
+        else:
+            return "O"
+
+    def get_msi(self): 
+        return self.get_sig("MSI")
+
+    def get_tmb(self):
+        return self.get_sig("TMB")
+
+    def get_covg_metrics(self):
+        has_new_covg = self.get_custom_field("ROI_20x") != ""
+        if has_new_covg:
+            bases_20x = self.get_custom_field("ROI_20x")
+            bases_200_or_250x = self.get_custom_field("ROI_250x")
+            bases_500x = self.get_custom_field("ROI_500x")
+            covg_mean = self.get_custom_field("Avg_ROI_Coverage")
+            return [round(float(x), 2) for x in [bases_20x, bases_200_or_250x, bases_500x, covg_mean]]
+        else:
+            covg_summary = self.header["coverageSummary"]
+            bases_20x = covg_summary["basesAt20x"]
+            bases_200_or_250x = covg_summary["basesAt200x"]
+            bases_500x = covg_summary["basesAt500x"]
+            covg_mean = round(covg_summary["meanDepth"])
+            return [round(float(x), 2) for x in [bases_20x, bases_200_or_250x, bases_500x, covg_mean]]
+
+    def get_custom_field(self, field_name):
+        custom_fields = self.header["customFields"]
+        if field_name in custom_fields:
+            return custom_fields[field_name]
+        else:
+            return ""
+
+    def get_pt_name(self):
+        # patient names are in the format "Last, First (MRN)"
+        name = self.sample_state["patientName"].split(" (")[0]
+        fn, ln = name.split(",")[:2]
+        return fn, ln
+
+    def get_mrn(self):
+        return str(self.sample_state["mrn"]).zfill(7)
+
+    def get_prov_name(self):
+        name = self.sample_state["orderingPhysician"]
+        fn, ln = name.split(",")[:2]
+        return fn.strip(), ln.strip()
+
+    def get_prov_id(self):
+        id =  str(self.get_custom_field("ProviderID"))
+        return id.zfill(6)
+
+    def format_header_date(self, date):
+        split_date = date.split("/")
+        if len(split_date) == 3:
+            m, d, y = split_date
+            if len(m) == 1: m = "0" + m
+            if len(d) == 1: d = "0" + d
+            return y + m + d
+        else:
+            raise Exception(f"Invalid date format: {date} found in JSON for {self.sample_id}, patient name: {self.pt_fn} {self.pt_ln}")
+
+    def get_date(self, date_type):
+        # date = self.get_custom_field(date_type).split(" ")[0]
+        if date_type.startswith("N_") or date_type.startswith("Date"):
+            date = self.get_custom_field(date_type).split(" ")[0]
+        else:
+            date = self.sample_state[date_type]
+        return self.format_header_date(date)
+
+    def get_date_sent(self):
+        return date.today().strftime("%Y%m%d")
+
+    def get_tumor_type(self):
+        tt = self.header["tumorType"]
+        tt_abbrev = self.header["tumorTypeAbbrev"]
+        return f"{tt} ({tt_abbrev})"
+
+    def get_variant_key(self, variant):
+        return (variant.get("projectTableRecordId"), variant.get("start"), variant.get("refAlt"))
+
+    # Indexes the biomarkers by identity and by record ID/coordinates, so get_clin_sig doesn't have to
+    # deep-compare each variant against every biomarker. Equal variants always share a key, so
+    # checking the few biomarkers under that key matches `variant in biomarkers` exactly
+    def get_tier1_index(self, biomarkers):
+        by_key = {}
+        for biomarker in biomarkers:
+            by_key.setdefault(self.get_variant_key(biomarker), []).append(biomarker)
+        return {id(biomarker) for biomarker in biomarkers}, by_key
+
+    def get_clin_sig(self, variant, tier1_ids, tier1_by_key):
+        if id(variant) in tier1_ids or variant in tier1_by_key.get(self.get_variant_key(variant), ()):
+            return "Tier 1: Strong significance"
+        else:
+            return "Tier 2: Potential significance"
+
+    def get_variant_type(self, variant):
+        tags = variant["tags"]
+        if tags and len(tags) == 1:
+            type_initials = tags[0]["initials"]
+            if type_initials == "SM":
+                return "Somatic"
+            elif type_initials == "GL":
+                return "Germline"
+        return "Unknown"
+    
+    def format_interp(self, interp):
+        return format_interp(interp)
+
+    def get_interp(self, variant):
+        summary = variant["biomarkerSummary"]
+        if summary:
+            return self.format_interp(summary["interpretation"])
+        else:
+            return ""
+
+    def get_chrom(self, variant):
+        mutation = variant["mutation"]
+        return mutation["chr"] if mutation else ""
+
+    def get_naf(self, variant):
+        naf = variant["naf"]
+        return round(naf, 2) if naf else 0
+
+    def get_consequence(self, variant):
+        consequence = SEQ_ONTOLOGY_MAP.get(variant["sequenceOntology"])
+        if consequence:
+            return consequence
+        else:
+            raise RuntimeError(f"SequenceOntology term {variant['sequenceOntology']} not found")
+
+    def get_dna_change(self, variant):
+        # count number of bases in ref and alt (excluding dashes) to determine if substitution or indel
+        ref, alt = map(lambda b: b.replace('-', ''), variant["refAlt"].split("/"))
+        return "Substitution" if len(alt) == len(ref) else "Insertion/Deletion"
+
+    def get_coords(self, variant):
+        # VarSeq usually uses 0 based coordinates for the starting position,
+        # so we increment "start" to get 1-based coordinates
+        # This is not true for insertions, so in that case we increment "stop" for congruency
+        start, stop = int(variant['start']), int(variant['stop'])
+        if start != stop:
+            start += 1
+        else: # insertion
+            stop += 1
+        return str(start), str(stop)
+
+    def get_loinc_info(self, code):
+        loinc_info = LOINC_PREFIXES.get(code)
+        if loinc_info:
+            return loinc_info
+        else:
+            raise RuntimeError("Invalid LOINC code: " + code)
+
+    def create_obx_segment(self, variant_id, loinc_code, value):
+        return f"""OBX|{self.next_obx_idx()}|{self.get_loinc_info(loinc_code)}|{variant_id}|{value}"""
+
+    # Variant OBXs are written straight into one buffer per message instead of building and joining
+    # a list per variant. They are separated by \r\n, so every segment but the first starts with one
+    def get_variant_obx_writer(self, out, variant_idx):
+        variant_id = get_variant_id(variant_idx)
+        def write_obx(loinc_code, value):
+            self.obx_idx += 1
+            out.write(f"{self.obx_sep}OBX|{self.obx_idx}|{self.get_loinc_info(loinc_code)}|{variant_id}|{value}")
+            self.obx_sep = "\r\n"
+        return write_obx
+
+    def get_pdot(self, variant):
+        return variant["pDot"] if variant["pDot"] else "p.?"
+
+    def get_vaf(self, variant):
+        if variant.get("vaf"):
+            return round(variant["vaf"], 2)
+        elif variant.get("sv_vaf"):
+            return round(variant["sv_vaf"], 2)
+		# If no VAF is given, calculate it from altReadCount and readDepth
+        elif variant["altReadCount"] and variant["readDepth"]:
+            return round(variant["altReadCount"] / variant["readDepth"], 2)
+        else:
+            raise RuntimeError(f"VAF not found for variant {variant['geneName']} {variant['cDot']}")
+
+    def get_variant_display_name(self, variant, pdot=None, molecular_cons=None):
+        pdot = pdot or self.get_pdot(variant)
+        pdot = "" if pdot == "p.?" else f"{pdot} - "
+        molecular_cons = molecular_cons or self.get_consequence(variant)
+        if molecular_cons == "Nonsense":
+            molecular_cons = "Nonsense Variant"
+        return f"{variant['geneName']} {pdot}{variant['cDot']} {molecular_cons}"
+
+    # Fields that both the tumor and normal OBXs use, derived once per variant when the report is loaded
+    def get_variant_fields(self, variant):
+        pdot = self.get_pdot(variant)
+        consequence = self.get_consequence(variant)
+        return {
+            "pdot": pdot,
+            "consequence": consequence,
+            "display_name": self.get_variant_display_name(variant, pdot, consequence),
+            "variant_type": self.get_variant_type(variant),
+            "clin_sig": variant.clin_sig,
+            "chrom": self.get_chrom(variant),
+        }
+
+    # Writes a variant's OBXs from the render cache, renumbering the cached segments for where the variant falls
+    def write_cached_variant_obxs(self, out, write_variant_obxs, kind, variant, fields, variant_idx):
+        digest = fields.get("digest")
+        if digest is None:
+            digest = fields["digest"] = variant.digest()
+        key = (kind, digest)
+        entry = self.render_cache.get(key)
+        if entry is None:
+            segments = []
+            write_variant_obxs(lambda loinc_code, value: segments.append((f"|{self.get_loinc_info(loinc_code)}|", f"|{value}")), variant, fields)
+            entry = (tuple(segments), None)
+        else:
+            self.cached_variants += 1
+        segments, numbered = entry
+        first_idx = self.obx_idx + 1
+        variant_id = get_variant_id(variant_idx)
+        if numbered is None or numbered[0] != first_idx or numbered[1] != variant_id:
+            block = "\r\n".join([f"OBX|{idx}{head}{variant_id}{tail}" for idx, (head, tail) in enumerate(segments, first_idx)])
+            numbered = (first_idx, variant_id, block)
+            self.render_cache.put(key, (segments, numbered))
+        out.write(self.obx_sep)
+        out.write(numbered[2])
+        self.obx_idx += len(segments)
+        self.obx_sep = "\r\n"
+
+    def write_tumor_variant_obxs(self, write_obx, variant, fields):
+        ref, alt = variant["refAlt"].split("/")
+        start, stop = self.get_coords(variant)
+        sv_vaf = variant.get("sv_vaf")
+        if sv_vaf:
+            variant_type = "Structural"
+            allele_depth = variant["sv_reads"]
+        else:
+            variant_type = "Simple"
+            allele_depth = variant["altReadCount"]
+        write_obx("48018-6", '^' + variant["geneName"] + '^') # Variant Name (This is also a discrete field in EPIC)
+        write_obx("47998-0", fields["display_name"]) # Variant Display Name
+        write_obx("81252-9", 'v1^' + variant['hgvsWithGene'] + '^ClinVar-V') # Discrete Genetic Variant
+        write_obx("48002-0", '^' + fields["variant_type"]) # Genomic Source Class
+        write_obx("83005-9", variant_type) # EPIC Variant Category (Simple, Complex, Fusion, etc.))
+        write_obx("53037-8", '^' + fields["clin_sig"]) # Genetic Sequence Variation Clinical Significance
+        write_obx("81258-6", self.get_vaf(variant)) # Allelic Frequency
+        write_obx("82121-5", allele_depth) # Allelic Read Depth
+        write_obx("48005-3", fields["pdot"]) # Amino Acid Change p.HGVS
+        write_obx("48019-4", '^' + self.get_dna_change(variant))
+        write_obx("48004-6", '^' + variant['cDot']) # DNA Change c.HGVS
+        write_obx("81290-9", variant["gDot"]) # Genomic DNA Change g.HGVS
+        write_obx("7400052", variant["proteinId"])
+        write_obx("51958-7", f"{variant['transcriptName']}^{variant['transcriptName']}^RefSeq-T") # Transcript Reference Sequence
+        write_obx("48000-4", fields["chrom"]) # Chromosome
+        write_obx("48006-1", '^' + fields["consequence"])
+        write_obx("69547-8", ref) # Genomic Reference Allele
+        write_obx("69551-0", alt) # Genomic Alternate Allele
+        write_obx("81254-5", f"{start}^{stop}") # Genomic Allele Start-End
+        write_obx("47999-8", variant["exon"]) # DNA Region
+        write_obx("62374-4", '^' + variant['assembly']) # Human Reference Sequence Assembly Version
+        write_obx("69548-6", "Detected") # Genetic Variant Assessment
+        interp = self.get_interp(variant)
+        if interp: write_obx("93364-8", interp)
+        zyg = variant.get("zygosity")
+        if zyg: write_obx("53034-5", '^' + zyg)
+        sv_len = variant.get("sv_len")
+        if sv_len: write_obx("81300-6", sv_len)
+
+    # While we send these variants in the tumor's HL7 message, we send them again here for the normal sample so we can get the normal allele frequency
+    def write_normal_variant_obxs(self, write_obx, variant, fields):
+        write_obx("48018-6", '^' + variant["geneName"] + '^') # Variant Name (This is also a discrete field in EPIC)
+        write_obx("47998-0", fields["display_name"]) # Variant Display Name
+        write_obx("81252-9", f"v1^{variant['hgvsWithGene']}^ClinVar-V") # Discrete Genetic Variant
+        write_obx("48002-0", '^' + fields["variant_type"]) # Genomic Source Class
+        write_obx("53037-8", '^' + fields["clin_sig"]) # Genetic Sequence Variation Clinical Significance
+        write_obx("81258-6", self.get_naf(variant)) # Allelic Frequency
+        write_obx("48005-3", fields["pdot"]) # Amino Acid Change p.HGVS
+        write_obx("48004-6", f"^{variant['cDot']}") # DNA Change c.HGVS
+        write_obx("48000-4", fields["chrom"]) # Chromosome
+        write_obx("48006-1", '^' + fields["consequence"])
+        write_obx("62374-4", '^' + variant['assembly']) # Human Reference Sequence Assembly Version
+        write_obx("83005-9", "Simple") # EPIC Variant Category (Simple, Complex, Fusion, etc.))
+        write_obx("69548-6", "Detected") # Genetic Variant Assessment
+        zyg = variant.get("zygosity")
+        if zyg: write_obx("53034-5", '^' + zyg)
+
+    def get_tumor_msg_header(self):
+        self.reset_obx_idx()
+        bases_20x, bases_200x, bases_500x, covg_mean = self.get_covg_metrics()
+        lab_code_segment = LAB_CODES.get(self.panel)
+        header = f"""MSH|^~\&|RRH||Beaker||{self.date_sent}||ORU^R01|{self.next_control_id()}|P|2.3||||||\r
+PID|1||{self.mrn}^^^MRN^MRN||{self.pt_ln}^{self.pt_fn}^||{self.bday}|{self.sex}\r
+ORC|RE\r
+OBR|1|{self.order_num}|{self.sample_id}^Beaker|{lab_code_segment}|||{self.date_ordered}|||||||||{self.prov_id}^{self.prov_ln}^{self.prov_fn}^^^^^^EPIC^^^^PROVID||||||{self.date_received}|||F\r
+{self.create_obx_segment("2a", "7102415", f"^{self.get_tumor_type()}")}\r
+{self.create_obx_segment("2a", "7102423", bases_20x)}\r
+{self.create_obx_segment("2a", "7102424", bases_200x)}\r
+{self.create_obx_segment("2a", "7102425", bases_500x)}\r
+{self.create_obx_segment("2a", "7102426", covg_mean)}\r"""
+        if self.panel == "UCLA Pan-Cancer All v1" or self.panel == "Pan-Cancer Solid Tumor Exon Targets":
+            header += f"""{self.create_obx_segment("2a", "81695-9", f"^{self.get_msi()}")}\r"""
+            header += f"""{self.create_obx_segment("2a", "94076-7", f"{self.get_tmb()}")}\r"""
+        return header
+
+    def get_normal_msg_header(self):
+        self.reset_obx_idx()
+        norm_sample_id = self.get_custom_field("N_SID").rstrip('R')
+        norm_order_num = self.get_custom_field("N_OrderID")
+        norm_date_ordered = self.get_date("N_DateOrdered")
+        norm_date_received = self.get_date("N_DateReceived")
+        return f"""MSH|^~\&|RRH||Beaker||{self.date_sent}||ORU^R01|{self.next_control_id()}|P|2.3||||||\r
+PID|1||{self.mrn}^^^MRN^MRN||{self.pt_ln}^{self.pt_fn}^||{self.bday}|{self.sex}\r
+ORC|RE\r
+OBR|1|{norm_order_num}|{norm_sample_id}^Beaker|LAB9056^Pan-cancer Panel, Comparator^BKREAP^^^^^^SOLID TUMOR PAN-CANCER PANEL|||{norm_date_ordered}|||||||||{self.prov_id}^{self.prov_ln}^{self.prov_fn}^^^^^^EPIC^^^^PROVID||||||{norm_date_received}|||F\r"""
+
+    def write_tumor_obxs(self, out):
+        self.obx_sep = ""
+        for idx, (variant, fields) in enumerate(zip(self.variants, self.variant_fields)):
+            if self.render_cache is not None:
+                self.write_cached_variant_obxs(out, self.write_tumor_variant_obxs, "tumor", variant, fields, idx)
+            else:
+                self.write_tumor_variant_obxs(self.get_variant_obx_writer(out, idx), variant, fields)
+
+    def write_normal_obxs(self, out):
+        self.obx_sep = ""
+        for idx, (variant, fields) in enumerate(self.germline_variants):
+            if self.render_cache is not None:
+                self.write_cached_variant_obxs(out, self.write_normal_variant_obxs, "normal", variant, fields, idx)
+            else:
+                self.write_normal_variant_obxs(self.get_variant_obx_writer(out, idx), variant, fields)
+
+    def get_tumor_obxs(self):
+        out = StringIO()
+        self.write_tumor_obxs(out)
+        return out.getvalue()
+
+    def get_normal_obxs(self):
+        out = StringIO()
+        self.write_normal_obxs(out)
+        return out.getvalue()
+
+    def get_tumor_msg(self):
+        out = StringIO()
+        out.write(self.get_tumor_msg_header())
+        self.write_tumor_obxs(out)
+        return out.getvalue()
+
+    def get_normal_msg(self):
+        if self.panel == "UCLA Pan-Cancer All v1" or self.panel == "Pan-Cancer Solid Tumor Exon Targets":
+            out = StringIO()
+            out.write(self.get_normal_msg_header())
+            self.write_normal_obxs(out)
+            if self.obx_sep:
+                return out.getvalue()
+        return ""